@@ -4,27 +4,38 @@ __version__ = '1.0.11'
 
 import os
 import sys
+import threading
 import time
 import warnings
+from Queue import Queue
+from collections import deque
 from itertools import chain, ifilter
 
 import dnuos.output.db
 import dnuos.path
-from dnuos import appdata, audiodir
-from dnuos.cache import Cache, memoized
+from dnuos import appdata, audiodir, audiotype
+from dnuos.cache import Cache, DirCache, FileCache, StampedCache, memoized
 from dnuos.conf import parse_args
 from dnuos.misc import dir_depth, equal_elements, formatwarning
-from dnuos.misc import merge, to_human, _
+from dnuos.misc import Exclusions, merge, to_human, _
 from dnuos.output.db import DBColumn
 
 __all__ = ['main']
 
+# Name of the files that exclude directories or entries below them
+IGNORE_FILE = '.dnuosignore'
+
+# Should be changed whenever the patterns read from ignore files change
+IGNORE_FILE_VERSION = '2'
+
 class Data(object):
     """Holds data for cache"""
 
     def __init__(self, unknown_types=()):
 
         self.bad_files = []
+        self.duplicates = []
+        self.other_fs = []
         self.size = {
             "Total": 0.0,
             "FLAC": 0.0,
@@ -42,26 +53,50 @@ class Data(object):
         }
 
 
-def make_raw_listing(basedirs, exclude_paths, sort_cmp, use_merge,
-                     adir_class):
+def make_raw_listing(basedirs, excluded, sort_key, use_merge,
+                     adir_class, jobs=1, max_depth=None, duplicates=None,
+                     ignore_cache=None, one_file_system=False,
+                     other_fs=None):
     """Make an iterator over all subdirectories of the base directories,
     including the base directories themselves. The directory trees are
     sorted either separately or together according to the merge setting.
+
+    With jobs greater than one, directories are loaded by that many
+    worker threads. The order of the directories is unaffected.
+
+    If max_depth is given, subdirectories more than max_depth levels
+    below their base directory are left out.
+
+    Each directory is visited only once, even if it can be reached
+    through symbolic links, or from more than one base directory. If
+    duplicates is given, (path, original path) tuples are appended to it
+    for the directories skipped.
+
+    Ignore files are read as described for walk(), using ignore_cache.
+
+    If one_file_system is true, subdirectories on other file systems
+    than their base directory are left out, and appended to other_fs if
+    it's given.
     """
 
+    visited = {}
     trees = []
     for basedir in basedirs:
         if dnuos.path.isdir(basedir):
-            trees.append(walk2(basedir, sort_cmp, exclude_paths))
+            trees.append(walk2(basedir, sort_key, excluded, max_depth,
+                               visited, duplicates, ignore_cache,
+                               one_file_system, other_fs))
         else:
             root = os.path.dirname(basedir)
-            trees.append([(basedir[len(root):], root)])
+            trees.append([(basedir[len(root):], root, None)])
 
     if use_merge:
-        tree = merge(trees, lambda a, b: sort_cmp(a[0], b[0]))
+        tree = merge(trees, lambda triple: sort_key(triple[0]))
     else:
         tree = chain(*trees)
 
+    if jobs > 1:
+        return to_adir_parallel(tree, adir_class, jobs)
     return to_adir(tree, adir_class)
 
 
@@ -89,20 +124,59 @@ def prepare_listing(dir_pairs, options, data):
         output_db_predicate = make_output_db_predicate(options)
         dir_pairs = ifilter(output_db_predicate, dir_pairs)
     if not options.output_module == dnuos.output.db:
-        dir_pairs = total_sizes(dir_pairs, data.size)
+        dir_pairs = total_sizes(dir_pairs, data.size, data.duplicates)
     if (not options.stripped and
         options.output_module in [dnuos.output.plaintext, dnuos.output.html]):
         dir_pairs = add_empty(dir_pairs)
     if options.list_files:
-        dir_pairs = add_files(dir_pairs, options.sort_cmp)
+        dir_pairs = add_files(dir_pairs, options.sort_key)
     return dir_pairs
 
 
-def setup_cache(cache_filename):
-    """Creates and readies cache"""
+def cache_name(filename, exact_length=False):
+    """Returns the file name of a cache called filename.
+
+    Results with exact MP3 lengths are kept in caches of their own, apart
+    from estimated ones.
+    """
+
+    if exact_length:
+        return filename + '-exact'
+    return filename
+
+
+def dir_cache_version():
+    """Returns the version of the cache of directories.
+
+    Dirs are made up of the parse results of their files, so the version
+    changes along with that of the results.
+    """
+
+    return '%s-%s' % (audiodir.Dir.__version__,
+                      audiotype.StreamInfo.__version__)
+
+
+def setup_cache(cache_filename, wal=False, exact_length=False):
+    """Creates and readies the cache of directories"""
+
+    return DirCache(filename=cache_name(cache_filename, exact_length),
+                    version=dir_cache_version(),
+                    wal=wal)
+
 
-    return Cache(filename=cache_filename,
-                 version=audiodir.Dir.__version__)
+def setup_file_cache(cache_filename, wal=False, exact_length=False):
+    """Creates and readies the cache of individual audio files"""
+
+    return FileCache(filename=cache_name(cache_filename, exact_length),
+                     version=audiotype.StreamInfo.__version__,
+                     wal=wal)
+
+
+def setup_ignore_cache(cache_filename, wal=False):
+    """Creates and readies the cache of patterns read from ignore files"""
+
+    return Cache(filename=cache_filename, version=IGNORE_FILE_VERSION,
+                 wal=wal)
 
 
 def setup_renderer(output_module, format_string, fields, options):
@@ -200,16 +274,40 @@ def main(argv=None, locale=''):
         return 0
 
     adir_class = audiodir.Dir
+    file_cache_view = None
+    # Without a cache, ignore files are still read only once per run
+    ignore_cache = StampedCache({})
     if options.use_cache:
         try:
             appdata.create_user_data_dir(options.cache_dir)
             cache = setup_cache(appdata.user_data_file('dirs',
-                                options.cache_dir))
+                                options.cache_dir), options.cache_wal,
+                                options.exact_length)
+            file_cache = setup_file_cache(appdata.user_data_file('files',
+                                          options.cache_dir),
+                                          options.cache_wal,
+                                          options.exact_length)
+            ignore_store = setup_ignore_cache(appdata.user_data_file(
+                                              'ignores', options.cache_dir),
+                                              options.cache_wal)
             if options.cull_cache:
                 culled = cache.cull()
+                file_cache.cull(dnuos.path.isfile)
+                ignore_store.cull(dnuos.path.isfile)
+                cache.save()
+                file_cache.save()
+                ignore_store.save()
                 print _('Culled %d non-existent directories') % culled
                 return 0
-            adir_class = memoized(audiodir.Dir, cache)
+            lock = None
+            if options.jobs > 1:
+                lock = threading.Lock()
+            adir_class = memoized(audiodir.Dir, cache, lock,
+                                  audiodir.Dir.refresh)
+            for basedir in options.basedirs:
+                cache.prefetch(basedir)
+            file_cache_view = StampedCache(file_cache, lock)
+            ignore_cache = StampedCache(ignore_store)
         except (ImportError, IOError), err:
             options.use_cache = False
             print >> sys.stderr, _('Failed to create cache directory:')
@@ -229,25 +327,66 @@ def main(argv=None, locale=''):
                                'information')
         return 2
 
-    # Append basedirs to exclude_paths to avoid traversing nested
-    # basedirs again.
-    adirs = make_raw_listing(options.basedirs,
-                             options.exclude_paths + options.basedirs,
-                             options.sort_cmp, options.merge, adir_class)
-    adirs = prepare_listing(adirs, options, data)
-    result = renderer.render(adirs, options, data)
-
-    # Output
-    outfile = (options.outfile and dnuos.path.open(options.outfile, 'w')
-               or sys.stdout)
+    pool = None
+    if options.processes > 1:
+        try:
+            pool = audiodir.make_pool(options.processes, options.exact_length)
+        except ImportError:
+            print >> sys.stderr, _('Worker processes require the '
+                                   'multiprocessing module (Python 2.6)')
+            return 2
+
+    # Settings of the classes only apply while the listing is output, so
+    # that they don't carry over to the next call. The pool is terminated
+    # along with them, whatever fails once it's been started.
+    dnuos.path.enable_stat_cache()
     try:
+        audiodir.Dir.pool = pool
+        audiodir.Dir.file_cache = file_cache_view
+        if options.trust_mtime:
+            audiodir.Dir.trust_mtime = options.trust_mtime * 24 * 60 * 60
+        audiotype.MP3.exact_length = options.exact_length
+        audiodir.Dir.linked_results = {}
+
+        # Append basedirs to exclude_paths to avoid traversing nested
+        # basedirs again.
+        excluded = Exclusions(options.exclude_paths + options.basedirs,
+                              options.exclude_patterns)
+        adirs = make_raw_listing(options.basedirs, excluded,
+                                 options.sort_key, options.merge,
+                                 adir_class, options.jobs,
+                                 options.max_depth, data.duplicates,
+                                 ignore_cache, options.one_file_system,
+                                 data.other_fs)
+        adirs = prepare_listing(adirs, options, data)
+        result = renderer.render(adirs, options, data)
+
+        # Output
+        outfile = (options.outfile and dnuos.path.open(options.outfile, 'w')
+                   or sys.stdout)
         for chunk in result:
             print >> outfile, chunk
     finally:
+        if audiodir.Dir.pool:
+            audiodir.Dir.pool.terminate()
+            audiodir.Dir.pool = None
+        audiodir.Dir.file_cache = None
+        audiodir.Dir.trust_mtime = None
+        audiotype.MP3.exact_length = False
+        audiodir.Dir.linked_results = None
+        saved = dnuos.path.disable_stat_cache()
+        if options.debug:
+            for path in data.other_fs:
+                print >> sys.stderr, _('Skipped %s on another file '
+                                       'system') % path
+            print >> sys.stderr, _('Stat cache saved %d system calls') % saved
+
         # Store updated cache
         if options.basedirs and options.use_cache:
             try:
                 cache.save()
+                file_cache.save()
+                ignore_store.save()
             except IOError, err:
                 print >> sys.stderr, _('Failed to save cache data:')
                 if options.debug:
@@ -351,14 +490,19 @@ def make_output_db_predicate(options):
     return output_db_predicate
 
 
-def total_sizes(dir_pairs, sizes):
+def total_sizes(dir_pairs, sizes, duplicates=None):
     """Calculate audio file size totals.
 
     Yields an unchanged iteration of dirs with an added side effect.
     After each directory is yielded its filesize statistics are
     added to sizes.
+
+    Files with hard links in more than one directory are counted only
+    once. If duplicates is given, (path, original path) tuples are
+    appended to it for the files not counted again.
     """
 
+    counted = {}
     for adir, root in dir_pairs:
         yield adir, root
         for mediatype, size in adir.sizes.items():
@@ -367,6 +511,17 @@ def total_sizes(dir_pairs, sizes):
             else:
                 sizes['Other'] += size
         sizes["Total"] += adir.size
+        for path, key, mediatype, size in adir.hardlinks:
+            if key not in counted:
+                counted[key] = path
+                continue
+            if mediatype in sizes:
+                sizes[mediatype] -= size
+            else:
+                sizes['Other'] -= size
+            sizes["Total"] -= size
+            if duplicates is not None:
+                duplicates.append((path, counted[key]))
 
 
 def timer_wrapper(dir_pairs, times):
@@ -422,7 +577,7 @@ def add_empty(dir_pairs):
         yield adir, root
 
 
-def add_files(dir_pairs, sort_cmp):
+def add_files(dir_pairs, sort_key):
     """Makes individual audiodirs for each audio file"""
 
     for adir, root in dir_pairs:
@@ -432,57 +587,286 @@ def add_files(dir_pairs, sort_cmp):
         if adir.num_files < 1:
             continue
         files = adir.audio_files
-        files.sort(sort_cmp)
+        files.sort(key=sort_key)
         for path in files:
             yield audiodir.Dir(path), root
 
 
-def walk2(basedir, sort_cmp, excluded):
+def walk2(basedir, sort_key, excluded, max_depth=None, visited=None,
+          duplicates=None, ignore_cache=None, one_file_system=False,
+          other_fs=None):
     """Traverse a directory tree in pre-order
 
     Walk2 is a thin wrapper around walk. It splits each path into a
-    (relpath, root) tuple where root is the parent directory of
-    basedir.
+    (relpath, root, entries) tuple where root is the parent directory of
+    basedir and entries is the directory listing of the path.
     """
 
     root = os.path.dirname(basedir)
-    for sub in walk(basedir, sort_cmp, excluded):
-        yield sub[len(root):], root
+    for sub, entries in walk(basedir, sort_key, excluded, max_depth,
+                             visited, duplicates, ignore_cache,
+                             one_file_system, other_fs):
+        yield sub[len(root):], root, entries
 
 
-def walk(dir_, sort_cmp, excluded):
+def walk(dir_, sort_key, excluded, max_depth=None, visited=None,
+         duplicates=None, ignore_cache=None, one_file_system=False,
+         other_fs=None):
     """Traverse a directory tree in pre-order.
 
-    Directories are sorted by sort_cmp and branches specified in
-    exclude are ignored. Symbolic links are followed.
+    Yields (path, entries) tuples where entries is the listing of path as
+    returned by dnuos.path.scandir. Each directory is listed only once.
+
+    Directories are sorted by sort_key and branches in excluded, a
+    container of paths such as misc.Exclusions, are ignored. Symbolic
+    links are followed. If max_depth is given, directories more than
+    max_depth levels below dir_ aren't visited.
+
+    Directories already visited, which symbolic links can lead back to,
+    are skipped. They're recognized by their (st_dev, st_ino) in the
+    visited dict, which maps them to the path they were visited by, and
+    can be shared between walks. If duplicates is given, (path, original
+    path) tuples are appended to it for the directories skipped.
+
+    A directory with an ignore file (see read_ignore_file) is skipped
+    along with its subdirectories if the file has no patterns. Otherwise
+    entries matching the patterns are left out of the listings of that
+    directory and the directories below it, without being stat'ed.
+
+    If one_file_system is true, directories on another device than dir_
+    are skipped along with their subdirectories, and appended to other_fs
+    if it's given. This keeps the walk out of mounted file systems.
+
+    The directories still to be visited are kept on a stack rather than
+    in nested generators, so deep trees cost no more per directory than
+    shallow ones.
+    """
+
+    if visited is None:
+        visited = {}
+    # Besides its path, depth and DirEntry, each directory on the stack
+    # carries the (path, misc.Exclusions) rules of the ignore files above
+    stack = [(dir_, 0, None, ())]
+    device = None
+    while stack:
+        path, depth, entry, rules = stack.pop()
+        try:
+            if entry is None:
+                stat = dnuos.path.stat(path)
+            else:
+                stat = entry.stat()
+        except OSError:
+            continue
+        if device is None:
+            device = stat.st_dev
+        elif one_file_system and stat.st_dev != device:
+            if other_fs is not None:
+                other_fs.append(path)
+            continue
+        # st_ino is 0 where the platform doesn't provide it
+        if stat.st_ino:
+            key = stat.st_dev, stat.st_ino
+            if key in visited:
+                if duplicates is not None:
+                    duplicates.append((path, visited[key]))
+                continue
+            visited[key] = path
+
+        try:
+            entries = dnuos.path.scandir(path)
+        except OSError:
+            continue
+        ignore_files = [entry for entry in entries
+                        if entry.name == IGNORE_FILE]
+        if ignore_files:
+            patterns = read_ignore_file(ignore_files[0], ignore_cache)
+            if patterns is not None:
+                if not patterns:
+                    continue
+                rules = rules + ((path, Exclusions((), patterns)),)
+        if rules:
+            entries = [entry for entry in entries
+                       if not is_ignored(entry.path, rules)]
+
+        if max_depth is None or depth < max_depth:
+            subs = [entry for entry in entries
+                    if entry.is_dir() and entry.path not in excluded]
+            subs.sort(key=lambda entry: sort_key(entry.path))
+            subs.reverse()
+            stack.extend([(sub.path, depth + 1, sub, rules)
+                          for sub in subs])
+
+        yield path, entries
+        del entries
+
+
+def read_ignore_file(entry, cache=None):
+    """Returns the patterns of an ignore file, given its DirEntry.
+
+    Each line of the file holds a shell-style wildcard pattern, as for
+    misc.Exclusions. Patterns with a path separator are relative to the
+    ignore file's directory, and are returned with a leading separator,
+    as they're matched against the path below it (see is_ignored). Other
+    patterns are matched against the names of entries at any depth below
+    the directory. Blank lines and lines starting with # are skipped. An
+    empty tuple means the whole directory is to be ignored, and None that
+    the file couldn't be read.
+
+    If cache, a dnuos.cache.StampedCache, is given, the patterns are
+    stored there, and the file is only read again once it changes. The
+    cache is kept apart from the parse results of audio files, as the
+    patterns don't depend on the parsers or their options.
     """
 
     try:
-        subs = dnuos.path.listdir(dir_)
+        stamp = audiodir.file_stamp(entry.stat())
     except OSError:
-        return
-    subs = [os.path.join(dir_, sub)
-            for sub in subs]
-    subs = [sub for sub in subs
-            if dnuos.path.isdir(sub)
-               and sub not in excluded]
-    subs.sort(sort_cmp)
+        return None
+    if cache is not None:
+        patterns = cache.get(entry.path, stamp)
+        if patterns is not None:
+            return patterns
 
-    yield dir_
-    for sub in subs:
-        for res in walk(sub, sort_cmp, excluded):
-            yield res
+    try:
+        file_ = dnuos.path.open(entry.path)
+        try:
+            lines = file_.read().splitlines()
+        finally:
+            file_.close()
+    except IOError:
+        return None
+    patterns = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        line = os.path.normpath(line).rstrip(os.path.sep)
+        # A leading separator anchors a pattern to the file's directory
+        if os.path.sep in line:
+            line = os.path.sep + line.lstrip(os.path.sep)
+        if line.strip(os.path.sep) and line != os.curdir:
+            patterns.append(line)
+    patterns = tuple(patterns)
+
+    if cache is not None:
+        cache.set(entry.path, stamp, patterns)
+    return patterns
+
+
+def is_ignored(path, rules):
+    """Returns whether any of the rules of ignore files exclude path.
+
+    rules is a sequence of (directory, misc.Exclusions) tuples, where the
+    patterns are relative to the directory. Patterns with a separator are
+    matched against the part of path below the directory, with a leading
+    separator.
+
+    >>> rules = [('/music', Exclusions((), ['Podcasts', '/Stems']))]
+    >>> is_ignored('/music/a/Podcasts', rules)
+    True
+    >>> is_ignored('/music/Stems', rules)
+    True
+    >>> is_ignored('/music/a/Stems', rules)
+    False
+    """
+
+    for dir_, exclusions in rules:
+        relpath = os.path.sep + path[len(dir_):].lstrip(os.path.sep)
+        if relpath in exclusions:
+            return True
+    return False
 
 
-def to_adir(path_pairs, constructor):
-    """Converts a sequence of path pairs into a sequence of dir pairs.
+def to_adir(path_triples, constructor):
+    """Converts a sequence of path triples into a sequence of dir pairs.
 
-    A path pair is a tuple (relpath, root). A dir pair is tuple (Dir,
-    root). The Dir is validated and root is assigned to it.
+    A path triple is a tuple (relpath, root, entries), where entries is
+    the directory listing of the path or None if it hasn't been listed.
+    A dir pair is tuple (Dir, root). The Dir is validated and root is
+    assigned to it.
     """
 
-    for relpath, root in path_pairs:
-        adir = constructor(root + relpath)
-        if not adir.is_valid():
-            adir.load()
-        yield adir, root
+    for relpath, root, entries in path_triples:
+        yield load_adir(constructor, relpath, root, entries)
+
+
+def load_adir(constructor, relpath, root, entries):
+    """Makes a validated dir pair from the parts of a path triple"""
+
+    return constructor(root + relpath, entries), root
+
+
+class _Job(object):
+    """A path triple queued for loading by a worker thread"""
+
+    __slots__ = ['triple', 'done', 'result', 'exc_info']
+
+    def __init__(self, triple):
+
+        self.triple = triple
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def wait(self):
+        """Waits for the job to finish and returns its dir pair"""
+
+        # Waiting with a timeout keeps the main thread responsive to
+        # KeyboardInterrupt.
+        while not self.done.isSet():
+            self.done.wait(1)
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+def _load_worker(queue, constructor):
+    """Loads queued jobs until a None job is received"""
+
+    while True:
+        job = queue.get()
+        if job is None:
+            break
+        try:
+            job.result = load_adir(constructor, *job.triple)
+        except:
+            job.exc_info = sys.exc_info()
+        job.done.set()
+
+
+def to_adir_parallel(path_triples, constructor, jobs, lookahead=None):
+    """Converts a sequence of path triples into a sequence of dir pairs
+    using a pool of worker threads.
+
+    The result is the same as that of to_adir, in the same order.
+    At most lookahead triples (default twice the number of jobs) are
+    read ahead of the directory being yielded. The constructor must be
+    safe to call from multiple threads.
+    """
+
+    if lookahead is None:
+        lookahead = 2 * jobs
+    queue = Queue()
+    workers = []
+    for i in xrange(jobs):
+        worker = threading.Thread(target=_load_worker,
+                                  args=(queue, constructor))
+        worker.setDaemon(True)
+        worker.start()
+        workers.append(worker)
+
+    pending = deque()
+    try:
+        for triple in path_triples:
+            job = _Job(triple)
+            queue.put(job)
+            pending.append(job)
+            if len(pending) >= lookahead:
+                yield pending.popleft().wait()
+        while pending:
+            yield pending.popleft().wait()
+    finally:
+        for worker in workers:
+            queue.put(None)
+    for worker in workers:
+        worker.join()
@@ -2,6 +2,8 @@
 
 import os
 import sys
+import time
+from stat import S_ISDIR
 from traceback import format_exception
 
 try:
@@ -23,24 +25,53 @@ class Dir(object):
     # attribute values is pickled to the database.
     __slots__ = ('albums', 'artists', '_audio_files', '_bad_files',
                  '_bitrates', '_lengths', '_types', 'modified', 'path',
-                 '_profiles', 'sizes', '_vendors', 'years')
+                 '_profiles', 'sizes', '_vendors', 'years', '_dir_stamp',
+                 '_checked', '_hardlinks')
 
     __version__ = '1.0.9'
 
-    def __init__(self, path):
+    # An optional multiprocessing.Pool used to parse audio files in
+    # worker processes (see --processes).
+    pool = None
+
+    # An optional dnuos.cache.StampedCache of parse results for
+    # individual audio files.
+    file_cache = None
+
+    # If set, a dir whose path has the same mtime, ctime and number of
+    # entries as when its files were last checked is assumed to be valid
+    # without looking at the files. They're still checked once this many
+    # seconds have passed (see --trust-mtime).
+    trust_mtime = None
+
+    # An optional dict of parse results of audio files with more than one
+    # link, keyed by (st_dev, st_ino), so that each is parsed only once
+    # per run.
+    linked_results = None
+
+    def __init__(self, path, entries=None):
         """Makes an empty Dir for path"""
 
         self.path = path
         self.modified = None
         self._audio_files = []
         self._bad_files = []
-        self.load()
+        self._dir_stamp = None
+        self._checked = None
+        self._hardlinks = ()
+        self.load(entries)
 
-    def load(self):
-        """Populates information based on audio files in the dir's path"""
+    def load(self, entries=None):
+        """Populates information based on audio files in the dir's path.
 
-        self._audio_files = self._parse_audio_files()
-        streams, self._bad_files = self.get_streams()
+        entries is an optional listing of the path as returned by
+        dnuos.path.scandir. If given, the directory isn't listed again.
+        """
+
+        audio_entries = self._list_audio_entries(entries)
+        self._audio_files = self._parse_audio_files(audio_entries)
+        streams, self._bad_files, self._hardlinks = \
+            self.get_streams(audio_entries)
         self.artists = self._parse_artist(streams)
         self.albums = self._parse_album(streams)
         self.years = self._parse_year(streams)
@@ -50,7 +81,61 @@ class Dir(object):
         self._bitrates = self._parse_bitrates(streams)
         self._profiles = self._parse_profile(streams)
         self._vendors = self._parse_vendors(streams)
-        self.modified = self._parse_modified()
+        self.modified = self._parse_modified(audio_entries)
+        self._dir_stamp = self._parse_dir_stamp(entries)
+        self._checked = time.time()
+
+    def refresh(self, entries=None):
+        """Reloads the dir unless it's valid.
+
+        entries is an optional listing of the path, as for load(). Returns
+        whether the dir has changed and should be stored again, which
+        includes updating when its files were last checked.
+        """
+
+        if Dir.trust_mtime and self._is_trusted(entries):
+            return False
+        if not self.is_valid(entries):
+            self.load(entries)
+            return True
+        if Dir.trust_mtime:
+            try:
+                self._dir_stamp = self._parse_dir_stamp(entries)
+            except OSError:
+                return False
+            self._checked = time.time()
+            return True
+        return False
+
+    def _is_trusted(self, entries=None):
+        """Returns whether the dir's path itself is unchanged since its
+        files were last checked, which wasn't too long ago.
+
+        Files changed in place don't change the directory's mtime, which
+        is why the files are still checked every now and then.
+        """
+
+        if self._dir_stamp is None or self._checked is None:
+            return False
+        if not 0 <= time.time() - self._checked < Dir.trust_mtime:
+            return False
+        try:
+            return self._parse_dir_stamp(entries) == self._dir_stamp
+        except OSError:
+            return False
+
+    def _parse_dir_stamp(self, entries=None):
+        """Returns the mtime, ctime and number of entries of the dir's path.
+
+        If the path is a file, the number of entries is None.
+        """
+
+        stat = dnuos.path.stat(self.path)
+        if not S_ISDIR(stat.st_mode):
+            return stat.st_mtime, stat.st_ctime, None
+        if entries is None:
+            entries = dnuos.path.listdir(self.path)
+        return stat.st_mtime, stat.st_ctime, len(entries)
 
     def depth_from(self, root):
         """Return the relative depth of the directory from the givenroot"""
@@ -68,23 +153,76 @@ class Dir(object):
 
         return [f for f in dnuos.path.listdir(self.path)]
 
-    def get_streams(self):
-        """Processes metadata in audio files"""
+    def get_streams(self, audio_entries=None):
+        """Processes metadata in audio files.
 
-        streams = []
-        bad_files = []
-        for child in self._audio_files:
-            filename = os.path.join(self.path, child)
+        Files that haven't changed since they were stored in file_cache
+        aren't parsed again. This includes files that failed to parse.
+
+        Returns the streams, the bad files, and a tuple of (name, st_dev,
+        st_ino, filetype, filesize) for each audio file with more than one
+        link.
+        """
+
+        if audio_entries is None:
+            audio_entries = [dnuos.path.DirEntry(os.path.join(self.path, f),
+                                                 f)
+                             for f in self._audio_files]
+
+        file_cache = Dir.file_cache
+        results = {}
+        stamps = {}
+        if file_cache:
+            for entry in audio_entries:
+                try:
+                    stamps[entry.path] = file_stamp(entry.stat())
+                except OSError:
+                    continue
+                result = file_cache.get(entry.path, stamps[entry.path])
+                if result is not None:
+                    results[entry.path] = result
+
+        links = {}
+        for entry in audio_entries:
             try:
-                streams.append(audiotype.openstream(filename))
-            except KeyboardInterrupt:
-                raise KeyboardInterrupt
-            except audiotype.SpacerError:
+                stat = entry.stat()
+            except OSError:
                 continue
-            except Exception:
-                traceback = ''.join(format_exception(*sys.exc_info()))
-                bad_files.append((child, traceback))
-        return streams, bad_files
+            if stat.st_nlink > 1 and stat.st_ino:
+                links[entry.path] = stat.st_dev, stat.st_ino
+        linked_results = Dir.linked_results
+        if linked_results is not None:
+            for path, key in links.iteritems():
+                if path not in results and key in linked_results:
+                    results[path] = linked_results[key]
+
+        filenames = [entry.path for entry in audio_entries
+                     if entry.path not in results]
+        if Dir.pool and len(filenames) > 1:
+            # Waiting with a timeout keeps the pool interruptible
+            parsed = Dir.pool.map_async(parse_file, filenames).get(1e9)
+        else:
+            parsed = [parse_file(filename) for filename in filenames]
+        for filename, result in zip(filenames, parsed):
+            results[filename] = result
+            if file_cache and filename in stamps:
+                file_cache.set(filename, stamps[filename], result)
+            if linked_results is not None and filename in links:
+                linked_results[links[filename]] = result
+
+        streams = []
+        bad_files = []
+        hardlinks = []
+        for entry in audio_entries:
+            stream, traceback = results[entry.path]
+            if stream is not None:
+                streams.append(stream)
+                if entry.path in links:
+                    hardlinks.append((entry.name,) + links[entry.path] +
+                                     (stream.filetype, stream.filesize))
+            elif traceback:
+                bad_files.append((entry.name, traceback))
+        return streams, bad_files, tuple(hardlinks)
 
     def _get_bad_files(self):
         """Returns a list of audio files that couldn't be parsed"""
@@ -93,6 +231,15 @@ class Dir(object):
                 in self._bad_files]
     bad_files = property(_get_bad_files)
 
+    def _get_hardlinks(self):
+        """Returns (path, (st_dev, st_ino), filetype, filesize) for each
+        audio file with more than one link.
+        """
+
+        return [(os.path.join(self.path, name), (dev, ino), type_, size)
+                for (name, dev, ino, type_, size) in self._hardlinks]
+    hardlinks = property(_get_hardlinks)
+
     def _get_num_files(self):
         """Returns the number of audio files"""
 
@@ -301,24 +448,31 @@ class Dir(object):
         return ', '.join([str(x) for x in res])
     audiolist_format = property(_get_audiolist_format)
 
-    def _parse_modified(self):
+    def _parse_modified(self, audio_entries):
         """Returns newest audio file's mtime"""
 
-        files = self.audio_files
-        files.append(self.path)
-        dates = [dnuos.path.getmtime(f) for f in files]
+        dates = [entry.stat().st_mtime for entry in audio_entries]
+        dates.append(dnuos.path.getmtime(self.path))
         return max(dates)
 
-    def _parse_audio_files(self):
+    def _list_audio_entries(self, entries=None):
+        """Returns DirEntry objects for the audio files in the dir's path.
+
+        If the path is a file rather than a directory, the path itself is
+        the only candidate.
+        """
+
+        if entries is None:
+            if dnuos.path.isdir(self.path):
+                entries = dnuos.path.scandir(self.path)
+            else:
+                entries = [dnuos.path.DirEntry(self.path, self.path)]
+        return [entry for entry in entries if self.is_audio_entry(entry)]
+
+    def _parse_audio_files(self, audio_entries):
         """Returns a list of files in the directory that are audio files"""
 
-        if dnuos.path.isdir(self.path):
-            return [filename for filename in self.children()
-                    if self.is_audio_file(os.path.join(self.path, filename))]
-        elif self.is_audio_file(self.path):
-            return [self.path]
-        else:
-            return []
+        return [entry.name for entry in audio_entries]
 
     def _get_audio_files(self):
         """Return a list of all audio files based on file extensions"""
@@ -327,17 +481,44 @@ class Dir(object):
                 for filename in self._audio_files]
     audio_files = property(_get_audio_files)
 
-    def is_valid(self):
-        """Returns whether or not the dir is completely valid"""
+    def is_valid(self, entries=None):
+        """Returns whether or not the dir is completely valid.
+
+        entries is an optional listing of the path, as for load().
+        """
 
         try:
-            valid = (self.modified == self._parse_modified() and
-                     self._audio_files == self._parse_audio_files() and
-                     len(self._bad_files) == 0)
+            audio_entries = self._list_audio_entries(entries)
+            valid = (self.modified == self._parse_modified(audio_entries) and
+                     self._audio_files ==
+                     self._parse_audio_files(audio_entries) and
+                     self._bad_files_unchanged(audio_entries))
         except OSError:
             valid = False
         return valid
 
+    def _bad_files_unchanged(self, audio_entries):
+        """Returns whether the dir's bad files are known to still be bad.
+
+        That's the case if file_cache holds the failures for the current
+        versions of the files. Otherwise they have to be parsed again.
+        """
+
+        if not self._bad_files:
+            return True
+        if not Dir.file_cache:
+            return False
+
+        entries = dict([(entry.name, entry) for entry in audio_entries])
+        for name, traceback in self._bad_files:
+            if name not in entries:
+                return False
+            entry = entries[name]
+            result = Dir.file_cache.get(entry.path, file_stamp(entry.stat()))
+            if result is None or result[1] is None:
+                return False
+        return True
+
     def is_audio_file(filename):
         """Test if a filename has the extension of an audio file
 
@@ -351,10 +532,80 @@ class Dir(object):
                 os.path.splitext(filename)[1][1:].lower() in Dir.valid_types)
     is_audio_file = staticmethod(is_audio_file)
 
+    def is_audio_entry(entry):
+        """Like is_audio_file, but for a dnuos.path.DirEntry.
+
+        The extension is checked first so that only possible audio files
+        are stat'ed.
+        """
+
+        return (os.path.splitext(entry.name)[1][1:].lower() in
+                Dir.valid_types and entry.is_file())
+    is_audio_entry = staticmethod(is_audio_entry)
+
     def __getstate__(self):
         return [getattr(self, attrname)
                 for attrname in Dir.__slots__]
 
     def __setstate__(self, state):
+        # State from before the dir stamp and hard links were added
+        # lacks them
+        self._dir_stamp = None
+        self._checked = None
+        self._hardlinks = ()
         for key, value in zip(Dir.__slots__, state):
             setattr(self, key, value)
+
+
+def file_stamp(stat):
+    """Returns what identifies a version of a file, given its stat result.
+
+    A file is assumed to be unchanged as long as its stamp is the same.
+    """
+
+    return stat.st_size, stat.st_mtime, stat.st_ino
+
+
+def parse_file(filename):
+    """Parses an audio file, returning a (StreamInfo, traceback) pair.
+
+    Either item is None. Both are None for spacer files. This may be run
+    in a worker process, so the result must be picklable.
+    """
+
+    try:
+        return audiotype.openinfo(filename), None
+    except KeyboardInterrupt:
+        raise KeyboardInterrupt
+    except audiotype.SpacerError:
+        return None, None
+    except Exception:
+        return None, ''.join(format_exception(*sys.exc_info()))
+
+
+def ignore_sigint():
+    """Makes the process ignore SIGINT, leaving it to the parent process."""
+
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def init_worker(exact_length):
+    """Readies a worker process to parse files like the parent process.
+
+    Used as the initializer of worker processes.
+    """
+
+    ignore_sigint()
+    audiotype.MP3.exact_length = exact_length
+
+
+def make_pool(processes, exact_length=False):
+    """Makes a multiprocessing.Pool for parsing audio files.
+
+    exact_length is the setting of audiotype.MP3.exact_length for the
+    worker processes.
+    """
+
+    from multiprocessing import Pool
+    return Pool(processes, init_worker, (exact_length,))
@@ -1,5 +1,6 @@
 """Classes for processing audio file metadata"""
 
+import mmap
 import os
 import re
 import string
@@ -13,13 +14,34 @@ class SpacerError(Exception):
     pass
 
 
+def byte_class(test):
+    """Return a regular expression matching any byte that passes test.
+
+    >>> byte_class(lambda b: 0x30 <= b < 0x33)
+    '[012]'
+    """
+
+    return '[%s]' % ''.join([re.escape(chr(b)) for b in xrange(256)
+                             if test(b)])
+
+
+def extension(filename):
+    """Return the lowercased extension of filename, without the dot.
+
+    >>> extension('Music/01 Track.MP3')
+    'mp3'
+    """
+
+    return os.path.splitext(filename)[1][1:].lower()
+
+
 class UnknownType(object):
 
     def __init__(self, file_):
 
         self.filename = file_
         self.filesize = dnuos.path.getsize(self.filename)
-        self.filetype = os.path.splitext(self.filename)[1][1:].lower()
+        self.filetype = extension(self.filename)
         self.vendor = ''
         self.version = ''
         self.brtype = ''
@@ -46,17 +68,106 @@ class UnknownType(object):
         return {}
 
 
+class Reader(object):
+    """Read-only file object that serves reads from in-memory windows.
+
+    The first head_size bytes of the file are read up front, and the last
+    tail_size bytes the first time anything in them is asked for. Reads
+    that fall inside either window are answered from memory, and window()
+    hands out buffers over them without copying. Anything else is read
+    from the file into a third window, which is replaced on every miss.
+    """
+
+    head_size = 64 * 1024
+    tail_size = 16 * 1024
+    miss_size = 16 * 1024
+
+    def __init__(self, file_, size):
+
+        self.name = file_.name
+        self.size = size
+        self._f = file_
+        self._pos = 0
+        self._head = (0, file_.read(self.head_size))
+        self._tail = None
+        self._miss = None
+
+    def seek(self, offset, whence=0):
+
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError(22, 'Invalid argument')
+        self._pos = offset
+
+    def tell(self):
+
+        return self._pos
+
+    def read(self, size=-1):
+
+        if size < 0:
+            size = max(self.size - self._pos, 0)
+        start, data = self._find(self._pos, size)
+        offset = self._pos - start
+        self._pos += size
+        return data[offset:offset + size]
+
+    def fileno(self):
+
+        return self._f.fileno()
+
+    def window(self, offset, size):
+        """Return a buffer over size bytes of the file at offset.
+
+        The buffer is shorter than size if the file ends before that.
+        """
+
+        if offset < 0:
+            raise IOError(22, 'Invalid argument')
+        start, data = self._find(offset, size)
+        return buffer(data, offset - start, size)
+
+    def _find(self, offset, size):
+        """Return a (start, data) window holding the requested range"""
+
+        end = min(offset + size, self.size)
+        for window in (self._head, self._tail, self._miss):
+            if (window and window[0] <= offset and
+                end <= window[0] + len(window[1])):
+                return window
+
+        if self._tail is None:
+            start = max(self.size - self.tail_size, len(self._head[1]))
+            if offset >= start:
+                self._f.seek(start)
+                self._tail = (start, self._f.read())
+                return self._tail
+
+        self._f.seek(offset)
+        self._miss = (offset, self._f.read(max(size, self.miss_size)))
+        return self._miss
+
+
 class AudioType(UnknownType):
     """Base audio file type"""
 
-    def __init__(self, file_):
+    def __init__(self, file_, reader=None):
+        """reader is an optional Reader of the file, if it has already
+        been opened.
+        """
 
         self.filename = file_
-        self._f = dnuos.path.open(self.filename, 'rb')
+        self.filesize = dnuos.path.getsize(self.filename)
+        if reader is None:
+            reader = Reader(dnuos.path.open(self.filename, 'rb'),
+                            self.filesize)
+        self._f = reader
         self._begin = None
         self._end = None
         self._meta = []
-        self.filesize = dnuos.path.getsize(self.filename)
         self.vendor = ''
         self.version = ''
         self.time = 9
@@ -74,22 +185,20 @@ class AudioType(UnknownType):
         if self._begin != None:
             return self._begin
 
-        mark = self._f.tell()
         self._begin = 0
 
         # check for prepended ID3v2
-        self._f.seek(0)
-        if self._f.read(3) == "ID3":
+        head = self._f.window(0, 14)
+        if head[:3] == "ID3":
             self._meta.append((0, "ID3v2"))
-            data = struct.unpack("<2x5B", self._f.read(7))
+            data = struct.unpack_from("<2x5B", head, 3)
             self._begin += 10 + unpack_bits(data[-4:])
             if data[0] & 0x40:
-                extsize = struct.unpack("<4B", self._f.read(4))
+                extsize = struct.unpack_from("<4B", head, 10)
                 self._begin += unpack_bits(extsize)
             if data[0] & 0x10:
                 self._begin += 10
 
-        self._f.seek(mark)
         return self._begin
 
     def stream_end(self):
@@ -97,26 +206,23 @@ class AudioType(UnknownType):
         if self._end != None:
             return self._end
 
-        mark = self._f.tell()
         self._end = self.filesize
 
         # check for ID3v1
-        self._f.seek(-128, 2)
-        if self._f.read(3) == "TAG":
+        if self._f.window(self.filesize - 128, 3)[:] == "TAG":
             self._end -= 128
             self._meta.append((self._end, "ID3v1"))
 
         # check for appended ID3v2
-        self._f.seek(self._end - 10)
-        if self._f.read(3) == "3DI":
-            data = struct.unpack("<2x5B", self._f.read(7))
+        tail = self._f.window(self._end - 10, 14)
+        if tail[:3] == "3DI":
+            data = struct.unpack_from("<2x5B", tail, 3)
             self._end -= 20 + unpack_bits(data[-4:])
             if data[0] & 0x40:
-                extsize = struct.unpack("<4B", self._f.read(4))
+                extsize = struct.unpack_from("<4B", tail, 10)
                 self._end -= unpack_bits(extsize)
                 self._meta.append((self._end, "ID3v2"))
 
-        self._f.seek(mark)
         return self._end
 
 
@@ -124,11 +230,17 @@ class Ogg(AudioType):
 
     filetype = "Ogg"
 
-    def __init__(self, file_):
+    # How many bytes at the end of the file are searched for the last
+    # page. The largest possible page is 65307 bytes.
+    tail_cap = 64 * 1024
 
-        AudioType.__init__(self, file_)
+    def __init__(self, file_, reader=None):
 
-        self.header = self.getheader()
+        AudioType.__init__(self, file_, reader)
+
+        self._serial = None
+        packets = self.packets()
+        self.header = self.getheader(packets.next())
         self.version = self.header[1]
         self.channels = self.header[2]
         self.freq = self.header[3]
@@ -139,7 +251,7 @@ class Ogg(AudioType):
         self._album = None
         self._year = None
 
-        self.comment = self.getcomment()
+        self.comment = self.getcomment(packets.next())
         for i in self.comment:
             field, value = i.split('=', 1)
             field = field.lower()
@@ -150,7 +262,7 @@ class Ogg(AudioType):
             elif field == "date":
                 self._year = value
 
-        self.audiosamples = self.lastgranule()[-1]
+        self.audiosamples = self.lastgranule()
         self.time = float(self.audiosamples) / self.freq
         self.brtype = "V"
 
@@ -166,100 +278,81 @@ class Ogg(AudioType):
 
         return {'vorbis': self._year}
 
-    def getheader(self):
-
-        # Setup header and sync stuff
-        syncpattern = '\x01vorbis'
-        overlap = len(syncpattern) - 1
-        headerformat = '<x6sIBI3iB'
-        headersize = struct.calcsize(headerformat)
-
-        # Read first chunk
-        self._f.seek(0)
-        start = self._f.tell()
-        chunk = self._f.read(1024 + overlap)
-
-        # Do all file if we have to
-        while len(chunk) > overlap:
-            # Look for sync
-            sync = chunk.find(syncpattern)
-            if sync != -1:
-                # Read the header
-                self._f.seek(start + sync)
-                return struct.unpack(headerformat, self._f.read(headersize))
-            # Read next chunk
-            start = start + 1024
-            self._f.seek(start + overlap)
-            chunk = chunk[-overlap:] + self._f.read(1024)
-
-    def getcomment(self):
-
-        # Get Ogg comment
-        syncpattern = '\x03vorbis'
-        overlap = len(syncpattern) - 1
-        jvlformat = "<7xI"
-        jvlformatsize = struct.calcsize(jvlformat)
-        llclformat = "<I"
-        llclformatsize = struct.calcsize(llclformat)
-
-        # Read first chunk
-        self._f.seek(0)
-        start = self._f.tell()
-        chunk = self._f.read(1024 + overlap)
-
-        # Do all file if we have to
-        while len(chunk) > overlap:
-            # Look for sync
-            sync = chunk.find(syncpattern)
-            if sync != -1:
-                self._f.seek(start + sync)
-                vendor_length = struct.unpack(jvlformat, self._f.read(
-                                              jvlformatsize))[0]
-                format = "<%ds" % vendor_length
-                self.vendor = struct.unpack(format, self._f.read(
-                                            struct.calcsize(format)))[0]
-                listlength = struct.unpack(llclformat,
-                                           self._f.read(llclformatsize))[0]
-                comments = []
-                for i in xrange(listlength):
-                    commentlength = struct.unpack(llclformat,
-                                        self._f.read(llclformatsize))[0]
-                    format = "<%ds" % commentlength
-                    tmpcomment = struct.unpack(format,
-                                   self._f.read(struct.calcsize(format)))[0]
-                    comments.append(tmpcomment)
-                return comments
-            # Read next chunk
-            start += 1024
-            self._f.seek(start + overlap)
-            chunk = chunk[-overlap:] + self._f.read(1024)
+    def packets(self):
+        """Iterate over the packets of the first logical stream.
+
+        Pages are walked from the start of the file by their headers, and
+        pages of other streams are skipped without being read.
+        """
+
+        offset = 0
+        packet = []
+        while offset + 27 <= self.filesize:
+            header = self._f.window(offset, 27)
+            if header[:5] != 'OggS\x00':
+                raise ValueError("No Ogg page at %d in %s" %
+                                 (offset, self.filename))
+            serial, segments = struct.unpack_from('<14xI8xB', header)
+            if self._serial is None:
+                self._serial = serial
+            lacing = map(ord, self._f.window(offset + 27, segments)[:])
+            offset += 27 + segments
+            if serial != self._serial:
+                offset += sum(lacing)
+                continue
+
+            start = offset
+            for size in lacing:
+                offset += size
+                if size < 255:
+                    packet.append(self._f.window(start, offset - start)[:])
+                    yield ''.join(packet)
+                    packet = []
+                    start = offset
+            if start < offset:
+                packet.append(self._f.window(start, offset - start)[:])
+
+        raise ValueError("Unexpected end of Ogg stream in %s" %
+                         self.filename)
+
+    def getheader(self, packet):
+
+        if packet[:7] != '\x01vorbis':
+            raise ValueError("No Vorbis identification header in %s" %
+                             self.filename)
+        return struct.unpack_from('<x6sIBI3iB', packet)
+
+    def getcomment(self, packet):
+
+        if packet[:7] != '\x03vorbis':
+            raise ValueError("No Vorbis comment header in %s" %
+                             self.filename)
+        self.vendor, comments = read_vorbis_comment(packet, 7,
+                                                    self.filename)
+        return comments
 
     def lastgranule(self):
-
-        # The setup header and sync stuff
-        syncpattern = 'OggS'
-        overlap = len(syncpattern) - 1
-        headerformat = '<4s2xl'
-        headersize = struct.calcsize(headerformat)
-
-        # Read last chunk
-        self._f.seek(-1024, 2)
-        start = self._f.tell()
-        chunk = self._f.read(1024)
-
-        # Do all file if we have to
-        while len(chunk) > overlap:
-            # Look for sync
-            sync = chunk.find(syncpattern)
-            if sync != -1:
-                # Read the header
-                self._f.seek(start + sync)
-                return struct.unpack(headerformat, self._f.read(headersize))
-
-            # Read next block
-            start = start - 1024
-            self._f.seek(start)
-            chunk = self._f.read(1024) + chunk[:overlap]
+        """Return the granule position of the last page of the stream.
+
+        The end of the file is searched backwards, looking at no more than
+        tail_cap bytes.
+        """
+
+        size = min(Reader.tail_size, self.tail_cap)
+        while True:
+            size = min(size, self.tail_cap, self.filesize)
+            tail = self._f.window(self.filesize - size, size)[:]
+            sync = tail.rfind('OggS', 0, size - 23)
+            while sync != -1:
+                granule, serial = struct.unpack_from('<6xqI', tail, sync)
+                if (tail[sync + 4] == '\x00' and serial == self._serial and
+                    granule != -1):
+                    return granule
+                sync = tail.rfind('OggS', 0, sync)
+            if size >= self.tail_cap or size >= self.filesize:
+                raise ValueError("No Ogg page in the last %d bytes of %s" %
+                                 (size, self.filename))
+            size *= 4
 
     def profile(self):
 
@@ -311,6 +404,16 @@ class MP3(AudioType):
 
     id3v2_frames = ['TPE1', 'TALB', 'TYER', 'TDRC']
 
+    # If set, the length of files without a Xing or VBRI header is found by
+    # walking all their frames rather than estimated from the first one
+    # (see --exact-length).
+    exact_length = False
+
+    # (size, samples, frequency, bitrate) of frames, indexed by the second
+    # and third bytes of their headers, or None for invalid headers. Built
+    # the first time it's needed.
+    _frametable = None
+
     def __init__(self, file_):
 
         AudioType.__init__(self, file_)
@@ -356,6 +459,14 @@ class MP3(AudioType):
                                   * 1000)
         self.time = self.streamsize() * 8.0 / self._bitrate
 
+        if self.exact_length and self.brtype == "C":
+            (self.framecount, self.time, framebytes,
+             bitrates) = self.scan_frames()
+            if len(bitrates) > 1:
+                self.brtype = "V"
+                self.framesize = framebytes
+                self._bitrate = int(framebytes * 8.0 / self.time)
+
         try:
             self.id3v1 = dnuos.id3.ID3v1(self._f)
         except dnuos.id3.Error:
@@ -407,7 +518,17 @@ class MP3(AudioType):
         else:
             return AudioType.streamsize(self)
 
-    _search_sync = re.compile('\xff[\xe0-\xff]').search
+    # How many bytes after the start of the stream are searched for the
+    # first frame before the file is given up on
+    sync_limit = 256 * 1024
+
+    # Matches exactly the frame headers that valid() accepts, so that all
+    # candidates in a block are checked by the regular expression engine
+    _search_sync = re.compile('\xff' +
+        byte_class(lambda b: b >> 5 == 7 and b >> 3 & 3 != 1 and
+                             b >> 1 & 3 != 0) +
+        byte_class(lambda b: b >> 4 not in (0, 15) and b >> 2 & 3 != 3) +
+        byte_class(lambda b: b & 3 != 2)).search
     _search_info = re.compile('(Xing|Info|VBRI)').search
 
     def getheader(self, offset=0):
@@ -415,57 +536,125 @@ class MP3(AudioType):
         _search_sync = self._search_sync
         _search_info = self._search_info
 
-        # Setup header and sync stuff
-        overlap = 1
         # frame header + presumed padding + xing/info header (oh god)
         pattern1 = '>l32x4s3l100xL9s2B8x2B5xH'
         # xing/info header
         pattern2 = '>4s3l100xL9s2B8x2B5xH' # 5xH adds preset info
         # vbri header
         pattern3 = '>4s6x2l'
-        pattern1size = struct.calcsize(pattern1)
-        pattern2size = struct.calcsize(pattern2)
-        pattern3size = struct.calcsize(pattern3)
 
-        # Read first block
-        self._f.seek(offset)
-        start = self._f.tell()
-        chunk = self._f.read(1024 + overlap)
-
-        # Do all file if we have to
-        while len(chunk) > overlap:
-            # Look for sync
-            sync = _search_sync(chunk)
-            while sync:
-                # Read header
-                self._f.seek(start + sync.start())
-                header = struct.unpack(pattern1, self._f.read(pattern1size))
-                if self.valid(header[0]):
-                    info = _search_info(chunk)
-                    while info:
-                        self._f.seek(start + info.start())
-                        if info.group() == 'VBRI':
-                            data = struct.unpack(pattern3,
-                                    self._f.read(pattern3size))
-                            return (header[0], data[0], None, data[2],
-                                    data[1], None, 'Fraunhofer')
-                        return (header[0],) + struct.unpack(pattern2,
-                                                self._f.read(pattern2size))
-                    return header
-
-                # How about next sync in this block?
-                sync = _search_sync(chunk, sync.start() + 1)
-
-            # Read next chunk
-            start = start + 1024
-            self._f.seek(start + overlap)
-            chunk = chunk[-overlap:] + self._f.read(1024)
+        # Search the stream block by block, each block being read (if it
+        # isn't in memory already) with enough slack for the headers
+        block = Reader.miss_size
+        end = min(offset + self.sync_limit, self.filesize)
+        for start in xrange(offset, end, block):
+            chunk = self._f.window(start, block + 256)
+            sync = _search_sync(chunk, 0, min(block + 3, len(chunk)))
+            if sync:
+                sync = sync.start()
+                self.firstframe = start + sync
+                header = struct.unpack_from(pattern1, chunk, sync)
+                # The info headers come right after the side information
+                info = _search_info(chunk, sync + 4, sync + 44)
+                if info:
+                    if info.group() == 'VBRI':
+                        data = struct.unpack_from(pattern3, chunk,
+                                                  info.start())
+                        return (header[0], data[0], None, data[2],
+                                data[1], None, 'Fraunhofer')
+                    return (header[0],) + struct.unpack_from(pattern2, chunk,
+                                                             info.start())
+                return header
+
         if offset >= self.filesize - 2:
             raise SpacerError("Spacer found %s" % self._f.name)
-        self._f.seek(offset)
-        tag = struct.unpack(">3s", self._f.read(struct.calcsize(">3s")))
-        if tag[0] == "TAG":
+        if self._f.window(offset, 3)[:] == "TAG":
             raise SpacerError("Spacer found %s" % self._f.name)
+        raise ValueError("No MP3 frame in the %d bytes after %d in %s" %
+                         (end - offset, offset, self.filename))
+
+    def scan_frames(self):
+        """Walk the frames of the stream from the first one.
+
+        Returns the number of frames, their total length in seconds, their
+        total size and the set of their bitrates. The file is mapped into
+        memory, and the frame headers are decoded with a lookup table.
+        Anything that isn't a frame is skipped by searching for the next
+        pair of frames.
+        """
+
+        if MP3._frametable is None:
+            MP3._frametable = self.frametable()
+        frametable = MP3._frametable
+        _search_sync = self._search_sync
+        unpack_from = struct.unpack_from
+
+        def frame_at(pos):
+            header = unpack_from('>I', data, pos)[0]
+            if header >> 24 != 0xff or header & 3 == 2:
+                return None
+            return frametable[header >> 8 & 0xffff]
+
+        frames = framebytes = 0
+        samples = {}
+        bitrates = set()
+        data = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = self.firstframe
+            end = min(self.stream_end(), len(data))
+            while pos + 4 <= end:
+                frame = frame_at(pos)
+                if frame is None:
+                    # Resynchronize on a frame that's followed by another
+                    sync = _search_sync(data, pos + 1, end)
+                    while sync:
+                        pos = sync.start()
+                        frame = frame_at(pos)
+                        if (pos + frame[0] + 4 > end or
+                            frame_at(pos + frame[0])):
+                            break
+                        sync = _search_sync(data, pos + 1, end)
+                    if not sync:
+                        break
+                size, count, freq, bitrate = frame
+                frames += 1
+                framebytes += size
+                samples[freq] = samples.get(freq, 0) + count
+                bitrates.add(bitrate)
+                pos += size
+        finally:
+            data.close()
+        time = sum([float(count) / freq
+                    for freq, count in samples.iteritems()])
+        return frames, time, framebytes, bitrates
+
+    def frametable(self):
+        """Return a table of frames for scan_frames"""
+
+        table = [None] * 0x10000
+        for index in xrange(0x10000):
+            header = 0xff000000 | index << 8
+            if not self.valid(header):
+                continue
+            versionindex = header >> 19 & 3
+            layerindex = header >> 17 & 3
+            bitrate = self.brtable[versionindex & 1][layerindex - 1][
+                header >> 12 & 15]
+            freq = self.fqtable[versionindex][header >> 10 & 3]
+            padding = header >> 9 & 1
+            if layerindex == 3:
+                # Layer I
+                samples = 384
+                size = (12000 * bitrate / freq + padding) * 4
+            elif layerindex == 1 and versionindex != 3:
+                # Layer III of MPEG 2 and 2.5
+                samples = 576
+                size = 72000 * bitrate / freq + padding
+            else:
+                samples = 1152
+                size = 144000 * bitrate / freq + padding
+            table[index] = (size, samples, freq, bitrate)
+        return table
 
     def modificator(self):
 
@@ -569,6 +758,8 @@ class MPC(AudioType):
 
     id3v2_frames = ['TPE1', 'TALB', 'TYER', 'TDRC']
 
+    fqtable = (44100, 48000, 37800, 32000)
+
     def __init__(self, file_):
 
         AudioType.__init__(self, file_)
@@ -591,15 +782,20 @@ class MPC(AudioType):
             'AbvBrnded',
             'AbvBrnded'
         )
-        fqtable = (44100, 48000, 37800, 32000)
-        self.freq = fqtable[self.getheader()[3]>>16 & 4]
-        self.framecount = self.getheader()[2]
-        self._bitrate = int(self.streamsize() * 144000.0 /
-                            float(self.framecount * self.freq))
-        self.time = (float(self.framecount) * 1.150 /
-                     float(44.1) + float(0.5))
+        self.header = self.getheader()
+        self.streamversion = self.header[0]
+        self.framecount = self.header[1]
+        self.freq = self.header[3]
+        if self.streamversion == 7:
+            self._bitrate = int(self.streamsize() * 144000.0 /
+                                float(self.framecount * self.freq))
+            self.time = (float(self.framecount) * 1.150 /
+                         float(44.1) + float(0.5))
+        else:
+            self.time = float(self.header[2]) / self.freq
+            self._bitrate = int(self.streamsize() * 8 / self.time)
         self.brtype = "V"
-        self.channels = "2"
+        self.channels = self.header[5]
 
         try:
             self.id3v1 = dnuos.id3.ID3v1(self._f)
@@ -645,55 +841,92 @@ class MPC(AudioType):
                     res['id3v2'] = frame.value
         return res
 
-    _search_header = re.compile('MP+').search
-
-    def headerstart(self):
-
-        _search_header = self._search_header
-        self._f.seek(0)
-        for x in xrange(self.filesize / 1024):
-            buf = self._f.read(1024)
-            if _search_header(buf):
-                return (x * 1024) + buf.find('MP+')
+    _search_header = re.compile(r'MP\+|MPCK').search
 
     def getheader(self):
+        """Find and parse the stream header.
+
+        Returns (stream version, frame count, sample count, sample rate,
+        profile index, channels).
+        """
+
+        begin = self.stream_begin()
+        head = self._f.window(begin, Reader.head_size)
+        sync = self._search_header(head)
+        while sync:
+            if sync.group() == 'MPCK':
+                return self.parse_packets(begin + sync.end())
+            version, frames, flags = struct.unpack_from('<3xB2i', head,
+                                                        sync.start())
+            if version & 0xF == 7:
+                return (7, frames, frames * 1152,
+                        self.fqtable[flags >> 16 & 3], flags >> 20 & 0xF, 2)
+            sync = self._search_header(head, sync.start() + 1)
+        raise ValueError("No Musepack stream header in %s" % self.filename)
+
+    def parse_packets(self, offset):
+        """Parse the packets of an SV8 stream up to its audio.
+
+        Returns the stream header like getheader().
+
+        >>> def varlen(n):
+        ...     data = chr(n & 0x7F)
+        ...     while n > 0x7F:
+        ...         n >>= 7
+        ...         data = chr(n & 0x7F | 0x80) + data
+        ...     return data
+        >>> def packet(key, data):
+        ...     return key + varlen(len(data) + 3) + data
+        >>> stream = ('MPCK' +
+        ...           packet('SH', chr(0) * 4 + chr(8) + varlen(441000) +
+        ...                        varlen(576) + chr(0x1F) + chr(0x10)) +
+        ...           packet('RG', chr(1) + chr(0) * 8) +
+        ...           packet('EI', chr(10 * 8 << 1) + chr(1) * 3) +
+        ...           packet('AP', chr(0) * 16))
+        >>> import StringIO
+        >>> file_ = StringIO.StringIO(stream)
+        >>> file_.name = 'test.mpc'
+        >>> mpc = MPC.__new__(MPC)
+        >>> mpc.filename, mpc.filesize = file_.name, len(stream)
+        >>> mpc._f = Reader(file_, len(stream))
+        >>> mpc.parse_packets(4)
+        (8, 383, 440424, 44100, 10, 2)
+        """
+
+        header = None
+        profile = 0
+        while offset < self.filesize:
+            data = self._f.window(offset, 11)
+            key = data[:2]
+            size, start = read_varlen(data, 2)
+            if size < start:
+                raise ValueError("Invalid %r packet size %d in %s" %
+                                 (key, size, self.filename))
+            if key == 'SH':
+                # Stream header, after its CRC and stream version
+                data = self._f.window(offset + start, size - start)
+                samples, pos = read_varlen(data, 5)
+                silence, pos = read_varlen(data, pos)
+                freq = self.fqtable[ord(data[pos]) >> 5]
+                channels = (ord(data[pos + 1]) >> 4) + 1
+                header = (8, (samples + 1151) / 1152, samples - silence,
+                          freq, channels)
+            elif key == 'EI':
+                # Encoder info, with the profile as a 4.3 fixed point number
+                profile = (ord(self._f.window(offset + start, 1)[0]) >>
+                           1) / 8
+            elif key in ('AP', 'SE'):
+                break
+            offset += size
 
-        _search_header = self._search_header
-
-        # Setup header and sync stuff
-        overlap = 1
-        pattern = '<3sb2i4h'
-        patternsize = struct.calcsize(pattern)
-
-        # Read first block
-        self._f.seek(0)
-        start = self._f.tell()
-        chunk = self._f.read(1024 + overlap)
-
-        # Do all file if we have to
-        while len(chunk) > overlap:
-            # Look for sync
-            sync = _search_header(chunk)
-            while sync:
-                # Read header
-                self._f.seek(start + sync.start())
-                header = struct.unpack(pattern, self._f.read(patternsize))
-
-                # Return the header if it's valid
-                if header[1] == 7:
-                    return header
-
-                # How about next sync in this block?
-                sync = _search_header(chunk, sync.start() + 1)
-
-            # Read next chunk
-            start = start + 1024
-            self._f.seek(start + overlap)
-            chunk = chunk[-overlap:] + self._f.read(1024)
+        if not header:
+            raise ValueError("No Musepack stream header in %s" %
+                             self.filename)
+        return header[:4] + (profile,) + header[4:]
 
     def profile(self):
 
-        return {"musepack": self.profiletable[self.getheader()[3] >> 20 & 0xF]}
+        return {"musepack": self.profiletable[self.header[4]]}
 
     def bitrate(self):
 
@@ -704,12 +937,10 @@ class FLAC(AudioType):
 
     filetype = "FLAC"
 
-    def __init__(self, file_):
+    def __init__(self, file_, reader=None):
 
-        AudioType.__init__(self, file_)
+        AudioType.__init__(self, file_, reader)
 
-        # [(sample number, byte offset, samples in frame), ...]
-        self.seekpoints = []
         # vorbis comments
         self.commentvendor = None
         self.comments = []
@@ -727,7 +958,6 @@ class FLAC(AudioType):
         # 7 total samples in stream
         # 8 MD5 sum of unencoded audio
 
-        self._f.seek(self.stream_begin())
         self.parse()
         self.samples = self.streaminfo[7]
         self.freq = self.streaminfo[4]
@@ -768,21 +998,10 @@ class FLAC(AudioType):
 
     def parse(self):
 
-        # STREAM
-        if struct.unpack('>4s', self._f.read(4))[0] != 'fLaC':
-            return
-
-        last = 0
-        while not last:
-            # METADATA_BLOCK_HEADER
-            data = struct.unpack('>I', self._f.read(4))[0]
-            last = data >> 31
-            type_ = data >> 24 & 0x7F
-            length = data & 0x00FFFFFF
-
+        for type_, data in self.blocks():
             if type_ == 0:
                 # Stream Info
-                data = struct.unpack('>3HI3Q', self._f.read(34))
+                data = struct.unpack_from('>3HI3Q', data)
                 self.streaminfo = (
                    data[0],
                    data[1],
@@ -792,40 +1011,67 @@ class FLAC(AudioType):
                    (data[4] >> 41 & 0x07) + 1,
                    (data[4] >> 36 & 0x1F) + 1,
                    data[4] & 0x0000000FFFFFFFFFL)
-            elif type_ == 3:
-                # Seektable
-                for i in xrange(length / 18):
-                    self.seekpoints.append(struct.unpack('<2QH',
-                        self._f.read(18)))
             elif type_ == 4:
                 # Vorbis Comment
-                self.commentvendor, self.comments = self.read_comment_header()
-            else:
-                # Padding or unknown
-                self._f.seek(length, 1)
+                self.commentvendor, self.comments = read_vorbis_comment(
+                    data, 0, self.filename)
 
-    def read_length(self):
+    def blocks(self):
+        """Iterate over the (type, data) of the STREAMINFO and
+        VORBIS_COMMENT metadata blocks.
 
-        length = struct.unpack('<I', self._f.read(4))[0]
-        if length >= self.streamsize():
-            raise ValueError
-        return length
+        The data is given as buffers over the file's windows. Other blocks
+        are skipped by their length without being read.
+        """
 
-    def read_string(self):
-        return self._f.read(self.read_length())
+        offset = self.stream_begin()
+        if self._f.window(offset, 4)[:] != 'fLaC':
+            return
+        offset += 4
 
-    def read_comment_header(self):
-        lst = []
-        vendor = self.read_string()
-        for i in xrange(self.read_length()):
-            lst.append(self.read_string())
-        return vendor, lst
+        last = 0
+        while not last:
+            # METADATA_BLOCK_HEADER
+            data = struct.unpack_from('>I', self._f.window(offset, 4))[0]
+            last = data >> 31
+            type_ = data >> 24 & 0x7F
+            length = data & 0x00FFFFFF
+            offset += 4
+            if type_ in (0, 4):
+                yield type_, self._f.window(offset, length)
+            offset += length
 
     def bitrate(self):
 
         return self._bitrate
 
 
+class OggFLAC(FLAC, Ogg):
+    """FLAC in an Ogg container"""
+
+    def blocks(self):
+        """Iterate over metadata blocks like FLAC.blocks.
+
+        The first packet is the mapping header, which holds STREAMINFO,
+        and it's followed by a packet for each of the other blocks.
+        """
+
+        self._serial = None
+        packets = self.packets()
+        packet = packets.next()
+        if packet[:5] != '\x7fFLAC' or packet[9:13] != 'fLaC':
+            raise ValueError("No FLAC mapping header in %s" % self.filename)
+        last = ord(packet[13]) >> 7
+        yield 0, buffer(packet, 17)
+
+        while not last:
+            packet = packets.next()
+            last = ord(packet[0]) >> 7
+            type_ = ord(packet[0]) & 0x7F
+            if type_ in (0, 4):
+                yield type_, buffer(packet, 4)
+
+
 class AAC(AudioType):
 
     filetype = "AAC"
@@ -859,138 +1105,204 @@ class AAC(AudioType):
 
         return {}
 
-    def getheader(self):
-
-        self._f.seek(0)
+    tag_boxes = {'\xa9ART': 0, '\xa9alb': 1, '\xa9day': 2}
 
-        start = self._f.tell()
-        overlap = 4
-        chunk = self._f.read(1024 + overlap)
-
-        length_found = False
-        stsd_found = False
-        artist_found = False
-        album_found = False
-        year_found = False
-        bitrate_found = False
+    def getheader(self):
 
-        cfl_fmt = ">I"
-        cfl_fmt_size = struct.calcsize(cfl_fmt)
+        moov = self.find_box('moov', 0, self.filesize)
+        if not moov:
+            raise ValueError("No moov box in %s" % self.filename)
+
+        track = None
+        tags = [None, None, None]
+        for type_, start, end in self.boxes(*moov):
+            if type_ == 'trak' and not track:
+                track = self.parse_track(start, end)
+            elif type_ == 'udta':
+                meta = self.find_box('meta', start, end)
+                if meta:
+                    tags = self.parse_meta(*meta)
+        if not track:
+            raise ValueError("No audio track in %s" % self.filename)
+
+        return tuple(tags) + track
+
+    def boxes(self, start, end):
+        """Iterate over the (type, start, end) of the boxes in a range.
+
+        Only box headers are read, so skipping a box costs nothing no
+        matter how large it is.
+        """
+
+        while start + 8 <= end:
+            size, type_ = struct.unpack_from('>I4s',
+                                             self._f.window(start, 8))
+            offset = 8
+            if size == 1:
+                size = struct.unpack_from('>Q',
+                                          self._f.window(start + 8, 8))[0]
+                offset = 16
+            elif size == 0:
+                size = end - start
+            if size < offset:
+                raise ValueError("Invalid %r box size %d in %s" %
+                                 (type_, size, self.filename))
+            yield type_, start + offset, min(start + size, end)
+            start += size
+
+    def find_box(self, type_, start, end):
+        """Return (start, end) of the first box of type_ in a range"""
+
+        for box in self.boxes(start, end):
+            if box[0] == type_:
+                return box[1:]
+        return None
+
+    def parse_track(self, start, end):
+        """Return (time, frequency, channels, bitrate) of a sound track"""
+
+        mdia = self.find_box('mdia', start, end)
+        if not mdia:
+            return None
+        hdlr = self.find_box('hdlr', *mdia)
+        if not hdlr or self._f.window(hdlr[0] + 8, 4)[:] != 'soun':
+            return None
+
+        mdhd = self.find_box('mdhd', *mdia)
+        if not mdhd:
+            return None
+        if self._f.window(mdhd[0], 1)[:] == '\x00':
+            unit, length = struct.unpack_from('>2I',
+                                              self._f.window(mdhd[0] + 12, 8))
+        else:
+            unit, length = struct.unpack_from('>IQ',
+                                              self._f.window(mdhd[0] + 20,
+                                                             12))
+        time = float(length) / unit
+
+        stsd = None
+        minf = self.find_box('minf', *mdia)
+        if minf:
+            stbl = self.find_box('stbl', *minf)
+            if stbl:
+                stsd = self.find_box('stsd', *stbl)
+        if not stsd:
+            return None
+
+        # The first sample entry, which starts with the common header of
+        # QuickTime sound descriptions and MP4 audio sample entries
+        entry = stsd[0] + 8
+        size, version, channels, rate = struct.unpack_from(
+            '>I12xH6xH6xI', self._f.window(entry, 36))
+        frequency = rate >> 16
 
-        # this stops things from blowing up if none are found
-        artist = None
-        album = None
-        year = None
         bitrate = 0.0
+        children = entry + 36 + {1: 16, 2: 36}.get(version, 0)
+        esds = self.find_box('esds', children, min(entry + size, stsd[1]))
+        if esds:
+            bitrate = self.parse_esds(*esds)
 
-        while len(chunk) > overlap:
-            # Get tracklength info from mvhd atom
-            if not length_found:
-                sync = chunk.find("mdhd")
-                if sync != -1:
-                    sync -= 4
-                    length_found = True
-                    self._f.seek(start + sync + 8)
-                    if self._f.read(1) == "\x00":
-                        sync += 20
-                        format = ">2I"
-                    else:
-                        sync += 28
-                        format = ">IQ"
-                    self._f.seek(start + sync)
-                    unit, length = struct.unpack(format, self._f.read(
-                        struct.calcsize(format)))
-                    time = float(length) / unit
-            # Get frequency and channel info from stsd atom
-            if not stsd_found:
-                sync = chunk.find("stsd")
-                if sync != -1:
-                    stsd_found = True
-                    self._f.seek(start + sync + 4 + 30)
-                    channels = struct.unpack(cfl_fmt, self._f.read(
-                        cfl_fmt_size))[0]
-                    self._f.seek(start + sync + 4 + 38)
-                    frequency = struct.unpack(cfl_fmt, self._f.read(
-                        cfl_fmt_size))[0]
-            # Get artist info from (c)ART atom
-            if not artist_found:
-                sync = chunk.find('\xa9ART')
-                if sync != -1:
-                    artist_found = True
-                    # Go back & read size of artist atom
-                    self._f.seek(start + sync - 4)
-                    length = struct.unpack(cfl_fmt, self._f.read(
-                        cfl_fmt_size))
-                    # Now we can get artist info, but first skip over junk bytes
-                    self._f.seek(start + sync + 20)
-                    format = "<%ds" % (length[0] - 24)
-                    artist = struct.unpack(format, self._f.read(
-                        struct.calcsize(format)))[0]
-            # Get album info from (c)album atom
-            if not album_found:
-                sync = chunk.find('\xa9alb')
-                if sync != -1:
-                    album_found = True
-                    # Go back and read size of ablum atom
-                    self._f.seek(start + sync - 4)
-                    length = struct.unpack(cfl_fmt, self._f.read(
-                        cfl_fmt_size))
-                    # get artist info, but skip over junk bytes
-                    self._f.seek( start + sync + 20 )
-                    format = "<%ds" % (length[0] - 24)
-                    album = struct.unpack(format, self._f.read(
-                        struct.calcsize(format)))[0]
-             # Get year info from (c)day atom
-            if not year_found:
-                sync = chunk.find('\xa9day')
-                if sync != -1:
-                    year_found = True
-                    # Go back and read size of day atom
-                    self._f.seek(start + sync - 4)
-                    length = struct.unpack(cfl_fmt, self._f.read(
-                        cfl_fmt_size))
-                    # get year info, but skip over junk bytes
-                    self._f.seek( start + sync + 20 )
-                    format = "<%ds" % (length[0] - 24)
-                    year = struct.unpack(format, self._f.read(
-                        struct.calcsize(format)))[0]
-            if not bitrate_found:
-                sync = chunk.find("esds")
-                if sync != -1:
-                    sync += 9
-                    self._f.seek(start + sync)
-                    if self._f.read(3) == "\x80\x80\x80":
-                        sync += 3
-                    sync += 4
-                    self._f.seek(start + sync)
-                    if self._f.read(1) == "\x04":
-                        sync += 1
-                        self._f.seek(start + sync)
-                        if self._f.read(3) == "\x80\x80\x80":
-                            sync += 3
-                        sync += 10
-                        self._f.seek(start + sync)
-                        bitrate = struct.unpack(">I", self._f.read(
-                            struct.calcsize(">I")))[0]
-                        if bitrate > 0:
-                            bitrate = bitrate / 1000 * 1000
-                        bitrate = float(bitrate)
-                        bitrate_found = True
-            if (length_found and stsd_found and artist_found and album_found
-                and year_found and bitrate_found):
-                break
+        return (time, frequency, channels, bitrate)
+
+    def parse_esds(self, start, end):
+        """Return the average bitrate from an elementary stream descriptor"""
 
-            start += 1024
-            self._f.seek(start + overlap)
-            chunk = chunk[-overlap:] + self._f.read(1024)
+        data = self._f.window(start + 4, end - start - 4)[:]
 
-        return (artist, album, year, time, frequency, channels, bitrate)
+        def descriptor(pos):
+            tag = ord(data[pos])
+            pos += 1
+            for i in xrange(4):
+                pos += 1
+                if not ord(data[pos - 1]) & 0x80:
+                    break
+            return tag, pos
+
+        tag, pos = descriptor(0)
+        if tag == 0x03:
+            flags = ord(data[pos + 2])
+            pos += 3
+            if flags & 0x80:
+                pos += 2
+            if flags & 0x40:
+                pos += 1 + ord(data[pos])
+            if flags & 0x20:
+                pos += 2
+            tag, pos = descriptor(pos)
+        if tag != 0x04:
+            return 0.0
+
+        bitrate = struct.unpack_from('>I', data, pos + 9)[0]
+        if bitrate > 0:
+            bitrate = bitrate / 1000 * 1000
+        return float(bitrate)
+
+    def parse_meta(self, start, end):
+        """Return [artist, album, year] from an iTunes metadata box"""
+
+        # Unlike ISO meta boxes, QuickTime ones don't carry version and flags
+        if self._f.window(start + 4, 4)[:] != 'hdlr':
+            start += 4
+
+        tags = [None, None, None]
+        ilst = self.find_box('ilst', start, end)
+        if not ilst:
+            return tags
+        for type_, start, end in self.boxes(*ilst):
+            if type_ in self.tag_boxes and tags[self.tag_boxes[type_]] is None:
+                data = self.find_box('data', start, end)
+                if data:
+                    tags[self.tag_boxes[type_]] = self._f.window(
+                        data[0] + 8, data[1] - data[0] - 8)[:]
+        return tags
 
     def bitrate(self):
 
         return self._bitrate
 
 
+def read_vorbis_comment(data, pos, filename):
+    """Read a Vorbis comment header at pos in data.
+
+    Returns the vendor string and the list of comments.
+    """
+
+    def read_string(pos):
+        length = struct.unpack_from('<I', data, pos)[0]
+        pos += 4
+        if pos + length > len(data):
+            raise ValueError("Invalid comment length %d in %s" %
+                             (length, filename))
+        return data[pos:pos + length], pos + length
+
+    vendor, pos = read_string(pos)
+    count = struct.unpack_from('<I', data, pos)[0]
+    pos += 4
+    comments = []
+    for i in xrange(count):
+        comment, pos = read_string(pos)
+        comments.append(comment)
+    return vendor, comments
+
+
+def read_varlen(data, pos):
+    """Read a Musepack SV8 variable length number.
+
+    Returns the number and the position after it.
+
+    >>> read_varlen('x' + chr(0x81) + chr(0x02), 1)
+    (130, 3)
+    """
+
+    value = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value = value << 7 | byte & 0x7F
+        if not byte & 0x80:
+            return value, pos
+
+
 def unpack_bits(bits):
     """Unpack ID3's syncsafe 7bit number format."""
 
@@ -1001,6 +1313,76 @@ def unpack_bits(bits):
     return value
 
 
+class StreamInfo(object):
+    """A compact summary of an audio stream.
+
+    Holds only what audiodir.Dir needs to know about an audio file. Unlike
+    the stream classes it doesn't keep the file open, so it can be pickled
+    and passed between processes.
+    """
+
+    __slots__ = ('filetype', 'filesize', 'time', 'brtype', 'vendor',
+                 '_bitrate', '_artist', '_album', '_year', '_profile')
+
+    # Should be changed whenever the parsers' results change, so that
+    # cached results of older versions are discarded.
+    __version__ = '1.0.12'
+
+    # The extensions of the files whose results changed in each version.
+    # Cached results of other files are kept when the version changes.
+    changes = [('1.0.9', ()),
+               ('1.0.10', ('ogg',)),
+               ('1.0.11', ('mpc', 'mp+')),
+               ('1.0.12', ('flac', 'fla', 'flc', 'ogg'))]
+
+    def __init__(self, stream):
+
+        self.filetype = stream.filetype
+        self.filesize = stream.filesize
+        self.time = stream.time
+        self.brtype = stream.brtype
+        self.vendor = stream.vendor
+        self._bitrate = stream.bitrate()
+        self._artist = stream.artist()
+        self._album = stream.album()
+        self._year = stream.year()
+        self._profile = stream.profile()
+
+    def bitrate(self):
+
+        return self._bitrate
+
+    def artist(self):
+
+        return self._artist
+
+    def album(self):
+
+        return self._album
+
+    def year(self):
+
+        return self._year
+
+    def profile(self):
+
+        return self._profile
+
+    def __getstate__(self):
+        return [getattr(self, attrname)
+                for attrname in StreamInfo.__slots__]
+
+    def __setstate__(self, state):
+        for key, value in zip(StreamInfo.__slots__, state):
+            setattr(self, key, value)
+
+
+def openinfo(filename):
+    """Opens filename like openstream and returns a StreamInfo for it"""
+
+    return StreamInfo(openstream(filename))
+
+
 def openstream(filename):
     """Factory function that creates an instance of the appropriate class for
     given audio file name.
@@ -1012,7 +1394,13 @@ def openstream(filename):
     elif lowername.endswith(".mpc") or lowername.endswith('.mp+'):
         return MPC(filename)
     elif lowername.endswith(".ogg"):
-        return Ogg(filename)
+        reader = Reader(dnuos.path.open(filename, 'rb'),
+                        dnuos.path.getsize(filename))
+        # Look at the first packet, which follows the first page header
+        head = reader.window(0, 64)
+        if len(head) > 27 and head[27 + ord(head[26]):][:5] == '\x7fFLAC':
+            return OggFLAC(filename, reader)
+        return Ogg(filename, reader)
     elif (lowername.endswith(".flac") or lowername.endswith('.fla') or
           lowername.endswith('.flc')):
         return FLAC(filename)
@@ -1,18 +1,57 @@
 """A module for caching"""
 
+from dnuos.audiotype import StreamInfo
+
 try:
-    from dnuos.cache.sqlitecache import Cache
+    from dnuos.cache.sqlitecache import Cache, DirCache, FileCache
 except ImportError:
-    from dnuos.cache.shelvecache import Cache
+    from dnuos.cache.shelvecache import Cache, FileCache
+    DirCache = Cache
+
+
+def _drop_types(types):
+    """Returns an update function that drops the entries of files of the
+    given types.
+    """
+
+    def update(cache):
+        cache.drop_types(types)
+    return update
+
+
+def _register_file_updates():
+    """Registers updates for per-file caches of older versions, which
+    drop the results of just the files whose parser has changed since.
+    """
 
+    changed = set()
+    versions = StreamInfo.changes[:]
+    versions.reverse()
+    for version, types in versions:
+        if version != StreamInfo.__version__:
+            FileCache.updates[version] = _drop_types(frozenset(changed))
+        changed.update(types)
 
-def memoized(func, cache):
+_register_file_updates()
+
+
+def memoized(func, cache, lock=None, refresh=None):
     """A decorator that caches a function's return value each time it's called.
 
     If called later with the same argument, the cached value is
     returned, and not re-evaluated.
 
-    The function must only take one argument: a string.
+    The function's first argument must be a string, which is used as
+    the key. Any further arguments are passed on to the function, but
+    aren't part of the key.
+
+    If refresh is given, it's called with each cached value that's
+    returned, and the further arguments. The value is stored again if
+    refresh returns true, meaning it was updated.
+
+    If lock is given, it's held while the cache is accessed, but not
+    while the function is evaluated. This makes the wrapper safe to call
+    from multiple threads.
 
     Example usage and behavior:
 
@@ -31,14 +70,88 @@ def memoized(func, cache):
     '[dir data]'
     """
 
-    def wrapper(key):
+    acquire, release = _lock_functions(lock)
+
+    def wrapper(key, *args):
         """Wrapper function"""
 
+        acquire()
+        try:
+            try:
+                value = cache[key]
+                cached = True
+            except KeyError:
+                cached = False
+        finally:
+            release()
+
+        if cached:
+            if not refresh or not refresh(value, *args):
+                return value
+        else:
+            value = func(key, *args)
+        acquire()
         try:
-            return cache[key]
-        except KeyError:
-            value = func(key)
             cache[key] = value
-            return value
+        finally:
+            release()
+        return value
 
     return wrapper
+
+
+class StampedCache(object):
+    """A view of a cache where each value is stored along with a stamp.
+
+    A value is only returned if it's looked up with the same stamp it was
+    stored with. A file's size and mtime can be used as a stamp, so that
+    changed files are ignored.
+
+    >>> cache = StampedCache({})
+    >>> cache.set('/some/file', (1024, 1234567890), '[file data]')
+    >>> cache.get('/some/file', (1024, 1234567890))
+    '[file data]'
+    >>> cache.get('/some/file', (2048, 1234567899)) is None
+    True
+    >>> cache.get('/other/file', (1024, 1234567890)) is None
+    True
+    """
+
+    def __init__(self, cache, lock=None):
+
+        self.cache = cache
+        self._acquire, self._release = _lock_functions(lock)
+
+    def get(self, key, stamp):
+        """Returns the value stored for key with stamp, or None"""
+
+        self._acquire()
+        try:
+            try:
+                stored_stamp, value = self.cache[key]
+            except KeyError:
+                return None
+        finally:
+            self._release()
+        if stored_stamp != stamp:
+            return None
+        return value
+
+    def set(self, key, stamp, value):
+        """Stores value for key with stamp"""
+
+        self._acquire()
+        try:
+            self.cache[key] = (stamp, value)
+        finally:
+            self._release()
+
+
+def _lock_functions(lock):
+    """Returns the acquire and release functions of lock, or functions that
+    do nothing if lock is None.
+    """
+
+    if lock is None:
+        return lambda: None, lambda: None
+    return lock.acquire, lock.release
@@ -4,14 +4,22 @@ import shelve
 import sys
 
 import dnuos.path
-
-updates = {}
+from dnuos.audiodir import Dir
+from dnuos.audiotype import extension
 
 class Cache(shelve.Shelf, object):
     """A dict with persistence, based on shelve.Shelf"""
 
-    def __init__(self, filename, version):
-        """Construct a new PersistentDict instance"""
+    # Functions converting the entries of a cache of an older version,
+    # keyed by that version. They are called with the cache.
+    updates = {}
+
+    def __init__(self, filename, version, wal=False):
+        """Construct a new PersistentDict instance
+
+        wal is accepted for compatibility with the sqlite3 cache, and
+        ignored.
+        """
 
         filename = filename.decode('utf-8')
         filename = filename.encode(sys.getfilesystemencoding())
@@ -24,15 +32,39 @@ class Cache(shelve.Shelf, object):
         self.version = version
         old_version = self.pop('__version__', None)
         if old_version != self.version:
-            if old_version in updates:
-                updates[old_version](self)
+            if old_version in self.updates:
+                self.updates[old_version](self)
+            else:
+                self.invalidate()
+
+    def invalidate(self):
+        """Invalidates the entries of an older version.
+
+        Dirs are kept, but are reloaded the next time they're looked at,
+        as their modification time won't match. Other entries are removed.
+        """
+
+        for key in self.keys():
+            value = self[key]
+            if isinstance(value, Dir):
+                value.modified = None
+                value._checked = None
+                self[key] = value
             else:
-                self.clear()
+                del self[key]
+
+    def prefetch(self, path):
+        """Does nothing, as the whole shelf is loaded anyway"""
 
-    def cull(self):
-        """Removes bad directories and returns count"""
+        pass
 
-        paths = [p for p in self.iterkeys() if not dnuos.path.isdir(p)]
+    def cull(self, exists=dnuos.path.isdir):
+        """Removes entries for paths that no longer exist and returns count.
+
+        By default entries are expected to be directories.
+        """
+
+        paths = [p for p in self.iterkeys() if not exists(p)]
         for path in paths:
             del self[path]
         return len(paths)
@@ -42,3 +74,18 @@ class Cache(shelve.Shelf, object):
 
         self['__version__'] = self.version
         self.close()
+
+
+class FileCache(Cache):
+    """A cache of parse results of audio files, based on shelve.Shelf"""
+
+    updates = {}
+
+    def drop_types(self, types):
+        """Deletes the entries of files of the given types, which are
+        their extensions.
+        """
+
+        for key in self.keys():
+            if extension(key) in types:
+                del self[key]
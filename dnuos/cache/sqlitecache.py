@@ -1,8 +1,11 @@
 """sqlite3-based cache"""
 
+import os
 import sqlite3
 import sys
+import time
 from UserDict import DictMixin
+from collections import deque
 
 try:
     import cPickle as pickle
@@ -10,61 +13,253 @@ except ImportError:
     import pickle
 
 import dnuos.path
+from dnuos.audiodir import Dir
+from dnuos.audiotype import extension
 
 class Cache(object, DictMixin):
-    """A dict with persistence, backed by sqlite3"""
+    """A dict with persistence, backed by sqlite3
 
-    def __init__(self, filename, version):
+    Values are pickled. The layout of the database is identified by
+    schema_version, which is stored in the database's user_version.
+
+    Each version of the cache has a file of its own. When there's no file
+    for the current version, the newest file of another version is renamed
+    to it, and its entries are converted by the function in updates for
+    its version. Otherwise the cache starts out empty, unless a subclass
+    takes the file over in another way (see DirCache).
+
+    Changes are committed in batches: once batch_size changes are pending,
+    once batch_time seconds have passed since the last commit, or when the
+    cache is saved.
+
+    If wal is true, the database uses write-ahead logging, which lets
+    other processes read the cache while it's being written to.
+
+    Rows looked up ahead of time, such as by DirCache.prefetch(), are held
+    in memory until they're looked up. At most prefetch_size rows are
+    held; older rows are dropped first and looked up on their own if
+    needed.
+    """
+
+    schema_version = 1
+
+    # Functions converting the entries of a cache of an older version,
+    # keyed by that version. They are called with the cache, once the
+    # older version's file has been renamed.
+    updates = {}
+
+    batch_size = 1000
+    batch_time = 10.0
+    prefetch_size = 20000
+
+    def __init__(self, filename, version, wal=False):
 
         filename = filename.decode('utf-8')
         filename = filename.encode(sys.getfilesystemencoding())
-        filename = '.'.join([filename, version, 'sqlite'])
+        path = '.'.join([filename, version, 'sqlite'])
+        old_version = None
+        if not os.path.exists(path):
+            old_version = self._take_previous(filename, path)
 
-        self._conn = sqlite3.connect(filename)
+        # The connection may be shared by worker threads (see --jobs),
+        # which serialize their access to the cache.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
         self._conn.text_factory = str
         c = self._conn.cursor()
         try:
-            c.execute('create table if not exists dirs '
-                      '(path text unique, dir blob)')
+            if wal:
+                c.execute('pragma journal_mode=wal')
+            # Databases older than user_version use schema 1
+            c.execute('pragma user_version')
+            schema_version = c.fetchone()[0] or 1
+            if schema_version != self.schema_version:
+                self._convert(c, schema_version)
+            self._create_tables(c)
+            c.execute('pragma user_version = %d' % self.schema_version)
             self._conn.commit()
         finally:
             c.close()
 
         self.version = version
+        self._pending = 0
+        self._last_commit = time.time()
+        self._prefetched = {}
+        self._prefetch_order = deque()
+
+        if old_version is not None:
+            self._update(old_version)
+            self._conn.commit()
+
+    def _take_previous(self, filename, path):
+        """Renames the newest file of another version to path, if its
+        entries can be converted or kept.
+
+        Returns the version of the renamed file, or None if there is none.
+        """
+
+        dirname, basename = os.path.split(filename)
+        prefix, suffix = basename + '.', '.sqlite'
+        try:
+            names = os.listdir(dirname or os.curdir)
+        except OSError:
+            return None
+        candidates = []
+        for name in names:
+            if (name.startswith(prefix) and name.endswith(suffix) and
+                len(name) > len(prefix) + len(suffix)):
+                old_path = os.path.join(dirname, name)
+                candidates.append((os.path.getmtime(old_path), old_path,
+                                   name[len(prefix):-len(suffix)]))
+        if not candidates:
+            return None
+
+        mtime, old_path, old_version = max(candidates)
+        if not self._can_update(old_version):
+            return None
+        os.rename(old_path, path)
+        # Changes not yet checkpointed are kept in the write-ahead log.
+        # The shared memory index is rebuilt from it.
+        if os.path.exists(old_path + '-wal'):
+            os.rename(old_path + '-wal', path + '-wal')
+        if os.path.exists(old_path + '-shm'):
+            os.remove(old_path + '-shm')
+        return old_version
+
+    def _create_tables(self, c):
+        """Creates the tables of the schema, if they don't exist"""
+
+        c.execute('create table if not exists dirs '
+                  '(path text unique, dir blob)')
+
+    def _convert(self, c, schema_version):
+        """Converts the database from another schema version.
+
+        This drops all tables, leaving an empty cache.
+        """
+
+        c.execute("select name from sqlite_master where type = 'table'")
+        for (table,) in c.fetchall():
+            c.execute('drop table "%s"' % table)
+
+    def _can_update(self, old_version):
+        """Returns whether the entries of a cache of old_version can be
+        taken over
+        """
+
+        return old_version in self.updates
+
+    def _update(self, old_version):
+        """Converts the entries of a cache of old_version, once its file
+        has been renamed
+        """
+
+        self.updates[old_version](self)
+
+    def _select(self, c, where, params):
+        """Returns (path, stored value) pairs of the rows in dirs matching
+        the where clause, ordered by path.
+        """
+
+        c.execute('select path, dir from dirs where %s order by path'
+                  % where, params)
+        return c.fetchall()
+
+    def _load(self, stored):
+        """Returns the value for a stored value returned by _select"""
+
+        return pickle.loads(str(stored))
+
+    def _insert(self, c, key, value):
+        """Inserts a row for key. There must be no row for key already."""
+
+        c.execute('insert into dirs values (?, ?)',
+                  (key, buffer(pickle.dumps(value, 2))))
+
+    def _delete(self, c, key):
+        """Deletes the row for key and returns the number of rows deleted"""
+
+        c.execute('delete from dirs where path = ?', (key,))
+        return c.rowcount
+
+    def prefetch(self, path):
+        """Does nothing, as rows are only looked up one at a time"""
+
+        pass
+
+    def _read_ahead(self, key):
+        """Reads the rows that are likely to be looked up along with key
+        into memory. Does nothing by default.
+        """
+
+        pass
+
+    def _hold(self, rows):
+        """Holds (path, stored value) rows read ahead of their lookup"""
+
+        for path, stored in rows:
+            if path not in self._prefetched:
+                self._prefetch_order.append(path)
+            self._prefetched[path] = stored
+        while len(self._prefetched) > self.prefetch_size:
+            self._prefetched.pop(self._prefetch_order.popleft(), None)
+        # Paths that have since been looked up are still in the order
+        if len(self._prefetch_order) > 2 * self.prefetch_size:
+            self._prefetch_order = deque([path for path
+                                          in self._prefetch_order
+                                          if path in self._prefetched])
 
     def __getitem__(self, key):
 
+        self._read_ahead(key)
+        if key in self._prefetched:
+            return self._load(self._prefetched.pop(key))
+
         c = self._conn.cursor()
         try:
-            c.execute('select dir from dirs where path = ? limit 1', (key,))
-            row = c.fetchone()
-            if not row:
+            rows = self._select(c, 'dirs.path = ?', (key,))
+            if not rows:
                 raise KeyError()
             else:
-                return pickle.loads(str(row[0]))
+                return self._load(rows[0][1])
         finally:
             c.close()
 
     def __setitem__(self, key, value):
 
+        self._prefetched.pop(key, None)
         c = self._conn.cursor()
         try:
-            c.execute('replace into dirs values (?, ?)',
-                      (key, buffer(pickle.dumps(value, 2))))
-            self._conn.commit()
+            self._delete(c, key)
+            self._insert(c, key, value)
         finally:
             c.close()
+        self._changed()
 
     def __delitem__(self, key):
 
+        self._prefetched.pop(key, None)
         c = self._conn.cursor()
         try:
-            c.execute('delete from dirs where path = ?', (key,))
-            self._conn.commit()
-            if c.rowcount == 0:
+            if self._delete(c, key) == 0:
                 raise KeyError()
         finally:
             c.close()
+        self._changed()
+
+    def _changed(self):
+        """Counts a pending change, committing if a batch is complete"""
+
+        self._pending += 1
+        if (self._pending >= self.batch_size or
+            time.time() - self._last_commit >= self.batch_time):
+            self.commit()
+
+    def commit(self):
+        """Commits pending changes"""
+
+        self._conn.commit()
+        self._pending = 0
+        self._last_commit = time.time()
 
     def keys(self):
 
@@ -80,8 +275,11 @@ class Cache(object, DictMixin):
         finally:
             c.close()
 
-    def cull(self):
-        """Removes bad directories and returns count"""
+    def cull(self, exists=dnuos.path.isdir):
+        """Removes entries for paths that no longer exist and returns count.
+
+        By default entries are expected to be directories.
+        """
 
         paths = []
         c = self._conn.cursor()
@@ -91,13 +289,15 @@ class Cache(object, DictMixin):
                 row = c.fetchone()
                 if not row:
                     break
-                if not dnuos.path.isdir(row[0]):
+                if not exists(row[0]):
                     paths.append(row[0])
         finally:
             c.close()
 
         for path in paths:
             del self[path]
+        # vacuum can't be run inside a transaction
+        self.commit()
 
         c = self._conn.cursor()
         try:
@@ -110,4 +310,365 @@ class Cache(object, DictMixin):
     def save(self):
         """Serializes data to file"""
 
+        self.commit()
         self._conn.close()
+
+
+class FileCache(Cache):
+    """A cache of parse results of audio files, backed by sqlite3
+
+    Along with each pickled result, the type of the file is stored, which
+    is its extension. This lets updates drop the results of just the types
+    whose parser has changed, with drop_types().
+    """
+
+    schema_version = 2
+
+    updates = {}
+
+    def _create_tables(self, c):
+        """Creates the tables of the schema, if they don't exist"""
+
+        c.execute('create table if not exists dirs '
+                  '(path text unique, dir blob, type text)')
+
+    def _convert(self, c, schema_version):
+        """Converts the database from another schema version.
+
+        The types of the files of schema 1 are added. Other schemas are
+        dropped.
+        """
+
+        c.execute("select name from sqlite_master "
+                  "where type = 'table' and name = 'dirs'")
+        if schema_version != 1 or not c.fetchone():
+            return super(FileCache, self)._convert(c, schema_version)
+
+        c.execute('alter table dirs add column type text')
+        c.execute('select path from dirs')
+        c.executemany('update dirs set type = ? where path = ?',
+                      [(extension(path), path) for (path,) in c.fetchall()])
+
+    def _insert(self, c, key, value):
+        """Inserts a row for key. There must be no row for key already."""
+
+        c.execute('insert into dirs values (?, ?, ?)',
+                  (key, buffer(pickle.dumps(value, 2)), extension(key)))
+
+    def drop_types(self, types):
+        """Deletes the entries of files of the given types"""
+
+        self._prefetched.clear()
+        c = self._conn.cursor()
+        try:
+            c.executemany('delete from dirs where type = ?',
+                          [(type_,) for type_ in types])
+        finally:
+            c.close()
+
+
+class DirCache(Cache):
+    """A cache of audiodir.Dir objects, backed by sqlite3
+
+    Instead of pickling, the fields of each Dir are stored in columns of
+    their own, and multi-valued fields in child tables keyed by dir_id.
+    This makes loading faster, and lets the cache be queried with SQL:
+
+        select path from dirs join dir_tags on dir_id = id
+        where field = 'artist' and value = 'Alva Noto'
+
+    In dir_tags, flags is 0 for a tag without values, 1 for a str value
+    and 2 for a unicode value, which is stored as UTF-8.
+    """
+
+    schema_version = 4
+
+    updates = {}
+
+    # Columns added by schema 3, holding a Dir's dir stamp and when its
+    # files were last checked
+    stamp_columns = ('dir_mtime integer', 'dir_ctime integer',
+                     'dir_entries integer', 'checked real')
+
+    # (field in dir_tags, Dir attribute)
+    tag_fields = (('artist', 'artists'), ('album', 'albums'),
+                  ('year', 'years'), ('profile', '_profiles'))
+
+    child_tables = ('dir_files', 'dir_types', 'dir_bitrates',
+                    'dir_vendors', 'dir_tags', 'dir_links')
+
+    def __init__(self, filename, version, wal=False):
+
+        self._roots = []
+        self._read_parents = set()
+        super(DirCache, self).__init__(filename, version, wal)
+
+    def prefetch(self, path):
+        """Prefetches the rows of all paths below path as they're needed.
+
+        The first lookup of a path below path reads the rows of the path
+        and all its siblings, which share its parent column. A walk looks
+        up the subdirectories of each directory together, in whatever
+        order it sorts them, so lookups are served by a query per parent
+        directory instead of a query per path.
+        """
+
+        self._roots.append(path.rstrip(os.sep) + os.sep)
+
+    def _read_ahead(self, key):
+        """Reads the rows of key's siblings, if key is below a prefetched
+        path and they haven't been read yet.
+        """
+
+        parent = os.path.dirname(key)
+        if parent in self._read_parents:
+            return
+        for root in self._roots:
+            if key.startswith(root):
+                break
+        else:
+            return
+
+        self._read_parents.add(parent)
+        c = self._conn.cursor()
+        try:
+            self._hold(self._select(c, 'dirs.parent = ?', (parent,)))
+        finally:
+            c.close()
+
+    def _create_tables(self, c):
+        """Creates the tables of the schema, if they don't exist"""
+
+        c.execute('create table if not exists dirs '
+                  '(id integer primary key, path text unique, '
+                  'parent text, modified integer, %s)'
+                  % ', '.join(self.stamp_columns))
+        c.execute('create index if not exists dirs_parent on dirs (parent)')
+        c.execute('create table if not exists dir_files '
+                  '(dir_id integer, name text, traceback text)')
+        c.execute('create table if not exists dir_types '
+                  '(dir_id integer, type text, size, length)')
+        c.execute('create table if not exists dir_bitrates '
+                  '(dir_id integer, bitrate, brtype text)')
+        c.execute('create table if not exists dir_vendors '
+                  '(dir_id integer, vendor text)')
+        c.execute('create table if not exists dir_tags '
+                  '(dir_id integer, field text, tag text, value, '
+                  'flags integer)')
+        c.execute('create table if not exists dir_links '
+                  '(dir_id integer, name text, dev integer, ino integer, '
+                  'type text, size integer)')
+        for table in self.child_tables:
+            c.execute('create index if not exists %s_dir_id on %s (dir_id)'
+                      % (table, table))
+
+    def _convert(self, c, schema_version):
+        """Converts the database from another schema version.
+
+        Dirs pickled by schema 1 are stored in columns. The columns of
+        schema 3 are added to schema 2, and the dirs of schemas 2 and 3,
+        which lack the dir_links table, are invalidated. Other schemas
+        are dropped.
+        """
+
+        if schema_version in (2, 3):
+            if schema_version == 2:
+                for column in self.stamp_columns:
+                    c.execute('alter table dirs add column ' + column)
+            self._invalidate(c)
+            return
+
+        c.execute("select name from sqlite_master "
+                  "where type = 'table' and name = 'dirs'")
+        if schema_version != 1 or not c.fetchone():
+            return super(DirCache, self)._convert(c, schema_version)
+
+        c.execute('alter table dirs rename to pickled_dirs')
+        self._create_tables(c)
+        rows = self._conn.cursor()
+        try:
+            rows.execute('select path, dir from pickled_dirs')
+            for path, stored in rows:
+                # Pickles of older versions can fail to load in many ways.
+                # Their dirs are left out, to be loaded again.
+                try:
+                    adir = pickle.loads(str(stored))
+                except Exception:
+                    continue
+                if not isinstance(adir, Dir):
+                    continue
+                self._insert(c, path, adir)
+        finally:
+            rows.close()
+        c.execute('drop table pickled_dirs')
+
+    def _can_update(self, old_version):
+        """Returns True, as the dirs of any version can be invalidated"""
+
+        return True
+
+    def _update(self, old_version):
+        """Converts the dirs of a cache of old_version by its function in
+        updates, or else invalidates them
+        """
+
+        if old_version in self.updates:
+            return super(DirCache, self)._update(old_version)
+        c = self._conn.cursor()
+        try:
+            self._invalidate(c)
+        finally:
+            c.close()
+
+    def _invalidate(self, c):
+        """Invalidates the entries of an older version.
+
+        The dirs are kept, but are reloaded the next time they're looked
+        at, as their modification time won't match and they aren't
+        trusted by their own mtime (see audiodir.Dir.trust_mtime). Audio
+        files that haven't changed are then looked up in the per-file
+        cache rather than parsed again.
+        """
+
+        c.execute('update dirs set modified = null, checked = null')
+
+    def _select(self, c, where, params):
+        """Returns (path, Dir) pairs of the dirs matching the where clause,
+        ordered by path.
+        """
+
+        c.execute('select id, path, modified, dir_mtime, dir_ctime, '
+                  'dir_entries, checked from dirs where %s order by path'
+                  % where, params)
+        rows = c.fetchall()
+        if not rows:
+            return []
+
+        states = {}
+        for id_, path, modified, mtime, ctime, entries, checked in rows:
+            if mtime is None:
+                dir_stamp = None
+            else:
+                dir_stamp = (mtime, ctime, entries)
+            state = {'path': path, 'modified': modified,
+                     '_dir_stamp': dir_stamp, '_checked': checked,
+                     '_audio_files': [], '_bad_files': [], '_types': [],
+                     'sizes': {}, '_lengths': {}, '_bitrates': [],
+                     '_vendors': [], '_hardlinks': []}
+            for field, attr in self.tag_fields:
+                state[attr] = {}
+            states[id_] = state
+
+        # Child rows are read in insertion order, which is the order of
+        # the values in the Dir that was stored.
+        join = ('from dirs join %s on %s.dir_id = dirs.id where ' + where +
+                ' order by %s.rowid')
+        c.execute('select dir_id, name, traceback ' +
+                  join % (('dir_files',) * 3), params)
+        for id_, name, traceback in c.fetchall():
+            states[id_]['_audio_files'].append(name)
+            if traceback is not None:
+                states[id_]['_bad_files'].append((name, traceback))
+        c.execute('select dir_id, type, size, length ' +
+                  join % (('dir_types',) * 3), params)
+        for id_, type_, size, length in c.fetchall():
+            states[id_]['_types'].append(type_)
+            states[id_]['sizes'][type_] = size
+            states[id_]['_lengths'][type_] = length
+        c.execute('select dir_id, bitrate, brtype ' +
+                  join % (('dir_bitrates',) * 3), params)
+        for id_, bitrate, brtype in c.fetchall():
+            states[id_]['_bitrates'].append((bitrate, brtype))
+        c.execute('select dir_id, vendor ' +
+                  join % (('dir_vendors',) * 3), params)
+        for id_, vendor in c.fetchall():
+            states[id_]['_vendors'].append(vendor)
+        c.execute('select dir_id, name, dev, ino, type, size ' +
+                  join % (('dir_links',) * 3), params)
+        for row in c.fetchall():
+            states[row[0]]['_hardlinks'].append(row[1:])
+        attrs = dict(self.tag_fields)
+        c.execute('select dir_id, field, tag, value, flags ' +
+                  join % (('dir_tags',) * 3), params)
+        for id_, field, tag, value, flags in c.fetchall():
+            values = states[id_][attrs[field]].setdefault(tag, [])
+            if flags == 2:
+                values.append(value.decode('utf-8'))
+            elif flags == 1:
+                values.append(value)
+
+        result = []
+        for row in rows:
+            id_, path = row[:2]
+            state = states[id_]
+            state['_types'] = tuple(sorted(state['_types']))
+            state['_bitrates'] = tuple(state['_bitrates'])
+            state['_vendors'] = tuple(state['_vendors'])
+            state['_hardlinks'] = tuple(state['_hardlinks'])
+            for field, attr in self.tag_fields:
+                state[attr] = dict([(k, tuple(v)) for (k, v)
+                                    in state[attr].iteritems()])
+            adir = Dir.__new__(Dir)
+            adir.__setstate__([state[attr] for attr in Dir.__slots__])
+            result.append((path, adir))
+        return result
+
+    def _load(self, stored):
+        """Returns the value for a stored value returned by _select"""
+
+        return stored
+
+    def _insert(self, c, key, adir):
+        """Inserts rows for key. There must be no rows for key already."""
+
+        state = dict(zip(Dir.__slots__, adir.__getstate__()))
+        dir_stamp = state['_dir_stamp'] or (None, None, None)
+        c.execute('insert into dirs (path, parent, modified, dir_mtime, '
+                  'dir_ctime, dir_entries, checked) '
+                  'values (?, ?, ?, ?, ?, ?, ?)',
+                  (key, os.path.dirname(key), state['modified']) +
+                  tuple(dir_stamp) + (state['_checked'],))
+        id_ = c.lastrowid
+
+        bad_files = dict(state['_bad_files'])
+        c.executemany('insert into dir_files values (?, ?, ?)',
+                      [(id_, name, bad_files.get(name))
+                       for name in state['_audio_files']])
+        types = set(state['_types'])
+        types.update(state['sizes'])
+        types.update(state['_lengths'])
+        c.executemany('insert into dir_types values (?, ?, ?, ?)',
+                      [(id_, type_, state['sizes'].get(type_),
+                        state['_lengths'].get(type_))
+                       for type_ in types])
+        c.executemany('insert into dir_bitrates values (?, ?, ?)',
+                      [(id_, bitrate, brtype)
+                       for bitrate, brtype in state['_bitrates']])
+        c.executemany('insert into dir_vendors values (?, ?)',
+                      [(id_, vendor) for vendor in state['_vendors']])
+        tags = []
+        for field, attr in self.tag_fields:
+            for tag, values in state[attr].iteritems():
+                if not values:
+                    tags.append((id_, field, tag, None, 0))
+                for value in values:
+                    if isinstance(value, unicode):
+                        tags.append((id_, field, tag, value.encode('utf-8'),
+                                     2))
+                    else:
+                        tags.append((id_, field, tag, value, 1))
+        c.executemany('insert into dir_tags values (?, ?, ?, ?, ?)', tags)
+        c.executemany('insert into dir_links values (?, ?, ?, ?, ?, ?)',
+                      [(id_,) + link for link in state['_hardlinks']])
+
+    def _delete(self, c, key):
+        """Deletes the rows for key and returns the number of dirs deleted"""
+
+        c.execute('select id from dirs where path = ?', (key,))
+        row = c.fetchone()
+        if not row:
+            return 0
+        for table in self.child_tables:
+            c.execute('delete from %s where dir_id = ?' % table, row)
+        c.execute('delete from dirs where id = ?', row)
+        return 1
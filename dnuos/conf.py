@@ -18,7 +18,7 @@ import dnuos.output.db
 import dnuos.output.html
 import dnuos.output.plaintext
 from dnuos import appdata
-from dnuos.misc import deprecation, natcmp, _
+from dnuos.misc import deprecation, natkey, _
 
 optparse._ = _
 
@@ -164,6 +164,38 @@ def set_preferred_tag(option, opt_str, value, parser):
         raise OptionValueError(_("Invalid argument to %s") % opt_str)
 
 
+def set_jobs(option, opt_str, value, parser):
+
+    if value >= 1:
+        parser.values.jobs = value
+    else:
+        raise OptionValueError(_('Number of jobs must be at least 1'))
+
+
+def set_processes(option, opt_str, value, parser):
+
+    if value >= 1:
+        parser.values.processes = value
+    else:
+        raise OptionValueError(_('Number of processes must be at least 1'))
+
+
+def set_trust_mtime(option, opt_str, value, parser):
+
+    if value >= 1:
+        parser.values.trust_mtime = value
+    else:
+        raise OptionValueError(_('Number of days must be at least 1'))
+
+
+def set_max_depth(option, opt_str, value, parser):
+
+    if value >= 0:
+        parser.values.max_depth = value
+    else:
+        raise OptionValueError(_('Depth must be at least 0'))
+
+
 def set_cache_dir(option, opt_str, value, parser):
 
     value = os.path.normpath(os.path.expanduser(value))
@@ -188,6 +220,11 @@ def add_exclude_dir(option, opt_str, value, parser):
         raise OptionValueError(_("No such directory: %s") % value)
 
 
+def add_exclude_pattern(option, opt_str, value, parser):
+
+    parser.values.exclude_patterns.append(os.path.normpath(value))
+
+
 def parse_format_string(data):
     r"""Extract field strings from input, replacing them with %s
 
@@ -244,6 +281,7 @@ def parse_args(argv=sys.argv):
     parser = OptionParser(usage, add_help_option=False)
     parser.set_defaults(bg_color="white",
                         cache_dir=appdata.user_data_dir('Dnuos', 'Dnuos'),
+                        cache_wal=False,
                         cull_cache=False,
                         debug=False,
                         delete_cache=False,
@@ -251,24 +289,32 @@ def parse_args(argv=sys.argv):
                         disp_result=False,
                         disp_time=False,
                         disp_version=False,
+                        exact_length=False,
                         exclude_paths=[],
+                        exclude_patterns=[],
                         fields=fields,
                         format_string=format_string,
                         indent=4,
+                        jobs=1,
                         list_bad=True,
+                        list_duplicates=False,
                         list_files=False,
+                        max_depth=None,
                         merge=False,
                         mp3_min_bit_rate=0,
                         no_cbr=False,
                         no_mixed=False,
                         no_non_profile=False,
+                        one_file_system=False,
                         outfile=None,
                         output_module=dnuos.output.plaintext,
                         prefer_tag=2,
+                        processes=1,
                         show_progress=True,
-                        sort_cmp=natcmp,
+                        sort_key=natkey,
                         stripped=False,
                         text_color="black",
+                        trust_mtime=None,
                         use_cache=True,
                         unknown_types=(),
                         wildcards=False)
@@ -285,9 +331,23 @@ def parse_args(argv=sys.argv):
     group.add_option("--debug",
                      dest="debug", action="store_true",
                      help=_('Output debug trace to stderr'))
+    group.add_option('--exact-length',
+                     dest='exact_length', action='store_true',
+                     help=_('Find the length of MP3 files without a Xing '
+                            'or VBRI header by reading all their frames'))
     group.add_option("--ignore-bad",
                      dest="list_bad", action="store_false",
                      help=_("Don't list files that cause Audiotype failure"))
+    group.add_option('--list-duplicates',
+                     dest='list_duplicates', action='store_true',
+                     help=_('List directories and files skipped because '
+                            'they were already seen through another path'))
+    group.add_option("--processes",
+                     action="callback", nargs=1,
+                     callback=set_processes, type="int",
+                     help=_('Parse audio files in N worker processes '
+                            '(default %s)') % parser.defaults['processes'],
+                     metavar=_('N'))
     group.add_option("-q", "--quiet",
                      dest="show_progress", action="store_false",
                      help=_('Omit progress indication'))
@@ -303,6 +363,10 @@ def parse_args(argv=sys.argv):
                      help=_('Store cache in DIR (default %s)') % (
                      parser.defaults['cache_dir']),
                      metavar=_('DIR'))
+    group.add_option('--cache-wal',
+                     dest='cache_wal', action='store_true',
+                     help=_('Let other processes read the cache while it '
+                            'is being written (SQLite write-ahead log)'))
     group.add_option('--cull-cache',
                      dest='cull_cache', action='store_true',
                      help=_('Cull non-existent cached directories and exit'))
@@ -312,6 +376,13 @@ def parse_args(argv=sys.argv):
     group.add_option('-C', '--disable-cache',
                      dest="use_cache", action="store_false",
                      help=_('Disable caching'))
+    group.add_option('--trust-mtime',
+                     action='callback', nargs=1,
+                     callback=set_trust_mtime, type='int',
+                     help=_("Assume cached directories whose own mtime "
+                            "hasn't changed are valid, checking their "
+                            "files every N days"),
+                     metavar=_('N'))
     parser.add_option_group(group)
 
 
@@ -320,17 +391,40 @@ def parse_args(argv=sys.argv):
                      action="callback", nargs=1,
                      callback=add_exclude_dir, type="string",
                      help=_('Exclude DIR from search'), metavar=_('DIR'))
+    group.add_option('--exclude-pattern',
+                     action='callback', nargs=1,
+                     callback=add_exclude_pattern, type='string',
+                     help=_('Exclude directories matching PATTERN, such as '
+                            '"*/Podcasts", from search'),
+                     metavar=_('PATTERN'))
     group.add_option("-i", "--ignore-case",
-                     dest="sort_cmp", action="store_const",
-                     const=lambda a, b: natcmp(a.lower(), b.lower()),
+                     dest="sort_key", action="store_const",
+                     const=lambda s: natkey(s.lower()),
                      help=_('Case-insensitive directory sorting'))
+    group.add_option('-j', '--jobs',
+                     action='callback', nargs=1,
+                     callback=set_jobs, type='int',
+                     help=_('Load N directories at a time using worker '
+                            'threads (default %s)') % (
+                     parser.defaults['jobs']),
+                     metavar=_('N'))
     group.add_option('-L', '--list-files',
                      dest='list_files', action='store_true',
                      help=_("List audio files in directories (doesn't use "
                             "caching)"))
+    group.add_option('--max-depth',
+                     action='callback', nargs=1,
+                     callback=set_max_depth, type='int',
+                     help=_('Descend at most N levels below basedirs'),
+                     metavar=_('N'))
     group.add_option("-m", "--merge",
                      dest="merge", action="store_true",
                      help=_('Parse basedirs in parallel and merge output'))
+    group.add_option('-x', '--one-file-system',
+                     dest='one_file_system', action='store_true',
+                     help=_("Don't descend into directories on other file "
+                            "systems than their basedir, listing them with "
+                            "--stats"))
     group.add_option('-u', '--unknown-types',
                      action='callback', nargs=1,
                      callback=set_unknown_types, type='string',
@@ -460,7 +554,7 @@ def expand(options, dir_):
 
     if options.wildcards and re.search("[*?]|(?:\[.*\])", dir_):
         dirs = glob.glob(dir_)
-        dirs.sort(options.sort_cmp)
+        dirs.sort(key=options.sort_key)
         return [os.path.abspath(d) for d in dirs]
     else:
         return [os.path.abspath(dir_)]
@@ -198,13 +198,19 @@ class ID3v2(object):
             self.tag_size = len(tag)
             fh = StringIO.StringIO(tag)
 
+        # Frame headers and the bodies of frames in limit_frames are read
+        # through a block of the tag. The bodies of other frames are
+        # skipped without being read.
+        pos = fh.tell()
+        block = _TagBlock(fh, pos + self.tag_size)
         sizeleft = self.tag_size
 
         # 11 == frame header + 1 byte frame, smallest legal frame
         while sizeleft >= 11:
-            frameid = fh.read(4)
+            header = block.get(pos, 8)
+            frameid = header[:4].tobytes()
             if _match_frame(frameid) or frameid in ID3v2Frames.frameTypes[self.version[1]]:
-                rawframesize = fh.read(4)
+                rawframesize = header[4:8].tobytes()
                 if self.version[1] >= 4 and frameid != 'COM ':
                     framesize = binfuncs.synchsafe2dec(rawframesize)
                     (framesize23,) = struct.unpack('!I', rawframesize)
@@ -222,12 +228,11 @@ class ID3v2(object):
                         break
                     else:
                         raise BrokenFrameError("Invalid frame size %r (raw: %r).  Frame type was %r. Corrupt tag." % (framesize,rawframesize,frameid,))
-                data = fh.read(framesize + 2)
-                if DEBUG_LEVEL >= 2:
-                    print "Raw frame: %r" % (data,)
+                pos += 8
             elif frameid == '\x00\x00\x00\x00' or frameid == 'MP3e':
                 # MP3ext http://www.mutschler.de/mp3ext/ puts "MP3ext " over and over in the padding
                 sizeleft -= 4
+                pos += 4
                 break
             else:
                 try:
@@ -239,6 +244,9 @@ class ID3v2(object):
 
             try:
                 if limit_frames and frameid in limit_frames:
+                    data = block.get(pos, framesize + 2).tobytes()
+                    if DEBUG_LEVEL >= 2:
+                        print "Raw frame: %r" % (data,)
                     self.new_frame(frameid, data)
             except BrokenFrameError, err:
                 if self.broken_frames == 'drop':
@@ -246,14 +254,43 @@ class ID3v2(object):
                     pass
                 else:
                     raise
+            pos += framesize + 2
             sizeleft -= (framesize + 2 + 4 + 4)
 
         if sizeleft:
             # TODO: perhaps detect mp3 frames?  that would be nice to know.
-            data = fh.read(sizeleft)
 #           if frameid != 'MP3e' and data != '\x00' * sizeleft:
 #               warnings.warn("Not all padding is NULLed out in %r.  Perhaps this tag was written by buggy software, or I didn't parsed it correctly. padding = %r" % (self.filename, frameid + data,))
             self.padding_size = sizeleft
+        fh.seek(pos + sizeleft)
+
+
+class _TagBlock(object):
+    """
+    Reads ranges of a tag through a block of it, which is read again
+    from the file whenever a range falls outside it
+    """
+
+    block_size = 64 * 1024
+
+    def __init__(self, fh, end):
+        self.fh = fh
+        self.end = end
+        self.start = 0
+        self.block = memoryview('')
+
+    def get(self, pos, size):
+        """
+        Return a memoryview of size bytes at pos, or less at end of file
+        """
+        offset = pos - self.start
+        if offset < 0 or offset + size > len(self.block):
+            self.fh.seek(pos)
+            self.block = memoryview(self.fh.read(
+                max(size, min(self.block_size, self.end - pos))))
+            self.start = pos
+            offset = 0
+        return self.block[offset:offset + size]
 
 
 class ID3v1(object):
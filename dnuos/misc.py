@@ -11,7 +11,8 @@ Feel free to organize this in a better way if you know how. I don't.
 import locale
 import os
 import re
-from heapq import heappop, heappush
+from fnmatch import translate
+from heapq import heapify, heappop, heapreplace
 from itertools import count
 from warnings import warn
 
@@ -52,74 +53,82 @@ def _natkey(s):
 
     return _natsub(lambda i: str(len(i.group())) + i.group(), s)
 
-def natcmp(a, b):
-    """Compare two strings for natural sorting"""
-
-    return locale.strcoll(_natkey(a), _natkey(b))
-
-class Lookahead(object):
-    """Wrapper class for adding one element of lookahead to an iterator.
-    Requires iterables of strings or sequences of strings.
-
-    Example behavior:
-
-    >>> x = Lookahead(iter(('0', '1', '2')))
-    >>> x.lookahead
-    '0'
-    >>> x.next()
-    '0'
-    >>> x.lookahead
-    '1'
-    >>> x.next()
-    '1'
-    >>> x.lookahead
-    '2'
-    >>> y = Lookahead(iter(('1', '2', '3')))
-    >>> y.next()
-    '1'
-    >>> x == y
+def natkey(s):
+    """Returns a key for sorting s naturally, collated by the locale.
+
+    The key is meant to be computed once per string, rather than on each
+    comparison.
+
+    >>> names = ['track10', 'Track9', 'track9']
+    >>> names.sort(key=natkey)
+    >>> names
+    ['Track9', 'track9', 'track10']
+    """
+
+    return locale.strxfrm(_natkey(s))
+
+
+class Exclusions(object):
+    """A set of excluded paths and path patterns.
+
+    Paths are kept in a hashed set. Patterns are shell-style wildcards,
+    all of which are compiled into a single regular expression. A pattern
+    without a path separator is matched against the last component of a
+    path, and other patterns against the whole path. Relative patterns
+    with a separator are matched against the end of the path, as if they
+    started with '*/'. As * also matches path separators, '*/Podcasts'
+    excludes every directory named Podcasts, as does 'Podcasts'.
+
+    >>> excluded = Exclusions(['/music/old'], ['Podcasts', '/music/*/tmp'])
+    >>> '/music/old' in excluded
     True
-    >>> y.next()
-    '2'
-    >>> x <= y
+    >>> '/music/old/album' in excluded
+    False
+    >>> '/music/a/Podcasts' in excluded
+    True
+    >>> '/music/a/b/tmp' in excluded
     True
-    >>> x.empty
+    >>> '/music/tmp' in excluded
     False
-    >>> x.next()
-    '2'
-    >>> x.empty
+    >>> excluded = Exclusions((), ['Artist/Live*'])
+    >>> '/music/Artist/Live 1999' in excluded
     True
+    >>> '/music/Other Artist/Live 1999' in excluded
+    False
     """
 
-    __slots__ = ['iterator', 'sort_cmp', 'lookahead', 'empty']
+    def __init__(self, paths=(), patterns=()):
 
-    def __init__(self, iterator, sort_cmp=cmp):
+        self._paths = set([os.path.normcase(p) for p in paths])
+        self._match_name = self._compile([p for p in patterns
+                                          if os.path.sep not in p])
+        self._match_path = self._compile([self._anchor(p) for p in patterns
+                                          if os.path.sep in p])
 
-        self.iterator = iterator
-        self.sort_cmp = sort_cmp
-        self.lookahead = None
-        self.empty = False
-        self.next()
+    def _anchor(pattern):
+        """Makes a relative pattern match the end of an absolute path"""
 
-    def __iter__(self):
+        if os.path.isabs(pattern) or pattern.startswith('*'):
+            return pattern
+        return os.path.join('*', pattern)
+    _anchor = staticmethod(_anchor)
 
-        return self
+    def _compile(patterns):
 
-    def next(self):
-        """Get next value"""
+        if not patterns:
+            return None
+        regexes = ['(?:%s)' % translate(os.path.normcase(p))
+                   for p in patterns]
+        return re.compile('|'.join(regexes)).match
+    _compile = staticmethod(_compile)
 
-        result = self.lookahead
-        try:
-            self.lookahead = self.iterator.next()
-        except StopIteration:
-            self.lookahead = None
-            self.empty = True
-        return result
+    def __contains__(self, path):
 
-    def __cmp__(self, other):
-        """Compare iterator heads (as opposed to the entire iterators)"""
-
-        return self.sort_cmp(self.lookahead, other.lookahead)
+        path = os.path.normcase(path)
+        return (path in self._paths or
+                bool(self._match_name and
+                     self._match_name(os.path.basename(path))) or
+                bool(self._match_path and self._match_path(path)))
 
 
 def deprecation(message):
@@ -192,38 +201,48 @@ def is_subdir(path1, path2):
     return path2 == path1[:len(path2)]
 
 
-def merge(iterators, sort_cmp=cmp):
+def merge(iterators, key=None):
     """Merge n ordered iterators into one ordered iterator.
 
+    The iterators must be ordered by key, which is computed once for each
+    element. Elements with equal keys are taken from the earlier iterator
+    first.
+
     Merge two ordered iterators
     >>> xs = iter(['a1', 'b1', 'c1'])
     >>> ys = iter(['a2', 'b2', 'c2'])
     >>> list(merge([xs, ys]))
     ['a1', 'a2', 'b1', 'b2', 'c1', 'c2']
+    >>> list(merge([['B', 'c'], ['a', 'C', 'd']], key=str.lower))
+    ['a', 'B', 'c', 'C', 'd']
     """
 
-    # Make a heap of the given iterators. The heap is sorted by the
-    # iterator head elements, or if those are equal, by the order of
-    # insertion. Thats what the index is for.
-    # Heappush and heappop use the __lt__ and __eq__ methods of the
-    # elements for the sorting. Generator items dont have meaningful
-    # comparison operators, so we wrap them in Lookahead which defines
-    # the inequality as per the respective head elements.
+    if key is None:
+        key = lambda element: element
+
+    # Make a heap of (key, index, element, iterator) tuples, one for the
+    # head element of each iterator. The index breaks ties between equal
+    # keys in favour of the earlier iterator, and keeps the elements and
+    # iterators themselves from being compared.
     heap = []
-    for index in range(0, len(iterators)):
-        iterator = Lookahead(iterators[index], sort_cmp)
-        if not iterator.empty:
-            heappush(heap, (iterator, index))
-
-    # Since all iterators are ordered (precondition) and the heap is ordered
-    # by head elements of the iterators, the head element of the head
-    # iterator on the heap is the smallest element of all remaining
-    # elements, and thus the next element in the ordered merged iteration.
+    for index, iterator in enumerate(iterators):
+        iterator = iter(iterator)
+        for element in iterator:
+            heap.append((key(element), index, element, iterator))
+            break
+    heapify(heap)
+
+    # Since all iterators are ordered (precondition), the head element
+    # at the top of the heap is the smallest of all remaining elements,
+    # and thus the next element in the ordered merged iteration.
     while heap:
-        iterator, index = heappop(heap)
-        yield iterator.next()
-        if not iterator.empty:
-            heappush(heap, (iterator, index))
+        element_key, index, element, iterator = heap[0]
+        yield element
+        for element in iterator:
+            heapreplace(heap, (key(element), index, element, iterator))
+            break
+        else:
+            heappop(heap)
 
 
 def to_human(value, radix=1024.0):
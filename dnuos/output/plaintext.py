@@ -19,10 +19,14 @@ class Renderer(AbstractRenderer):
              self.render_directories(dir_pairs, not options.stripped)),
             (lambda: data.bad_files,
              self.render_bad_files(data.bad_files)),
+            (lambda: options.list_duplicates and data.duplicates,
+             self.render_duplicates(data.duplicates)),
             (lambda: options.disp_time,
              self.render_generation_time(data.times)),
             (lambda: options.disp_result,
              self.render_sizes(data.size, data.times)),
+            (lambda: options.disp_result and data.other_fs,
+             self.render_other_fs(data.other_fs)),
             (lambda: options.disp_version,
              render_version(dnuos.__version__)),
         ]
@@ -56,6 +60,11 @@ class Renderer(AbstractRenderer):
         yield _('Audiotype failed on the following files:')
         yield "\n".join([f[0] for f in bad_files])
 
+    def render_duplicates(self, duplicates):
+
+        yield _('Skipped the following duplicates:')
+        yield "\n".join([_('%s (same as %s)') % dup for dup in duplicates])
+
     def render_generation_time(self, times):
 
         elapsed_time = locale.format('%8.2f', times['elapsed_time'])
@@ -87,6 +96,11 @@ class Renderer(AbstractRenderer):
         yield _('| Speed %s Mb/s |') % speed
         yield _('+-----------------------+')
 
+    def render_other_fs(self, other_fs):
+
+        yield _('Skipped the following directories on other file systems:')
+        yield "\n".join(other_fs)
+
 
 def render_version(version):
 
@@ -12,6 +12,9 @@ a different encoding, due to decoding to unicode beforehand.
 
 import os
 import sys
+import threading
+from collections import deque
+from stat import S_ISDIR, S_ISREG
 
 def listdir(path):
 
@@ -45,6 +48,56 @@ def listdir(path):
     return paths
 
 
+class DirEntry(object):
+    """A single entry of a directory listing, as returned by scandir().
+
+    The entry is stat'ed at most once. The file type tests and stat()
+    all share the same result, so asking for the type of an entry and
+    later for its size or mtime doesn't hit the file system again.
+    """
+
+    __slots__ = ['name', 'path', '_stat']
+
+    def __init__(self, path, name):
+
+        self.path = path
+        self.name = name
+        self._stat = None
+
+    def stat(self):
+        """Returns the (cached) stat result for the entry"""
+
+        if self._stat is None:
+            self._stat = stat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        """Returns True if the entry is a directory, following symlinks"""
+
+        try:
+            return S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        """Returns True if the entry is a regular file, following symlinks"""
+
+        try:
+            return S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+
+def scandir(path):
+    """Returns a list of DirEntry objects for the entries in path.
+
+    Raises OSError if path can't be listed.
+    """
+
+    return [DirEntry(os.path.join(path, name), name)
+            for name in listdir(path)]
+
+
 def _wrap(func):
 
     def wrapper(path, *args, **kw):
@@ -55,16 +108,160 @@ def _wrap(func):
     return wrapper
 
 
-exists = _wrap(os.path.exists)
+def _uncache(func):
+
+    def wrapper(path, *args, **kw):
+        if _stat_cache is not None:
+            for arg in (path,) + args:
+                if isinstance(arg, basestring):
+                    _stat_cache.forget(arg)
+        return func(path, *args, **kw)
+    return wrapper
+
+
+class StatCache(object):
+    """Stat results of paths, remembered for the duration of a run.
+
+    While a directory is walked, validated and loaded, the same paths are
+    stat'ed several times. Once the cache is enabled with
+    enable_stat_cache(), stat() and the functions based on it look paths
+    up here first. Failures are remembered too.
+
+    Only the max_size most recent results are kept. saved counts the
+    stat calls that were answered from the cache, which dnuos reports
+    with --debug. The cache may be shared by threads.
+
+    >>> cache = StatCache(max_size=2)
+    >>> result = cache.stat(os.curdir)
+    >>> cache.forget(os.curdir)
+    >>> result = cache.stat(os.curdir)
+    >>> result = cache.stat(os.pardir)
+    >>> result = cache.stat(os.curdir)
+    >>> cache.saved
+    1
+    """
+
+    def __init__(self, max_size=10000):
+
+        self.max_size = max_size
+        self.saved = 0
+        self._results = {}
+        self._order = deque()
+        self._lock = threading.Lock()
+
+    def stat(self, path):
+        """Returns the stat result for path, or raises its OSError"""
+
+        self._lock.acquire()
+        try:
+            result = self._results.get(path)
+            if result is not None:
+                self.saved += 1
+        finally:
+            self._lock.release()
+
+        if result is None:
+            try:
+                result = _stat(path)
+            except OSError, err:
+                result = err
+            self._lock.acquire()
+            try:
+                if path not in self._results:
+                    self._order.append(path)
+                self._results[path] = result
+                while len(self._order) > self.max_size:
+                    del self._results[self._order.popleft()]
+            finally:
+                self._lock.release()
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def forget(self, path):
+        """Drops the result for path, which is about to change"""
+
+        self._lock.acquire()
+        try:
+            if self._results.pop(path, None) is not None:
+                self._order.remove(path)
+        finally:
+            self._lock.release()
+
+
+_stat_cache = None
+
+
+def enable_stat_cache(max_size=10000):
+    """Starts remembering stat results until disable_stat_cache()"""
+
+    global _stat_cache
+    _stat_cache = StatCache(max_size)
+
+
+def disable_stat_cache():
+    """Stops remembering stat results.
+
+    Returns the number of stat calls that the cache saved.
+    """
+
+    global _stat_cache
+    cache, _stat_cache = _stat_cache, None
+    return cache and cache.saved or 0
+
+
+_stat = _wrap(os.stat)
+
+
+def stat(path):
+    """Returns os.stat(path), using the stat cache if it's enabled"""
+
+    cache = _stat_cache
+    if cache is None:
+        return _stat(path)
+    return cache.stat(path)
+
+
+def exists(path):
+
+    try:
+        stat(path)
+    except OSError:
+        return False
+    return True
+
+
+def getmtime(path):
+
+    return stat(path).st_mtime
+
+
+def getsize(path):
+
+    return stat(path).st_size
+
+
+def isdir(path):
+
+    try:
+        return S_ISDIR(stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def isfile(path):
+
+    try:
+        return S_ISREG(stat(path).st_mode)
+    except OSError:
+        return False
+
+
 expanduser = _wrap(os.path.expanduser)
-getmtime = _wrap(os.path.getmtime)
-getsize = _wrap(os.path.getsize)
-isdir = _wrap(os.path.isdir)
-isfile = _wrap(os.path.isfile)
-mkdir = _wrap(os.mkdir)
-makedirs = _wrap(os.makedirs)
+mkdir = _uncache(_wrap(os.mkdir))
+makedirs = _uncache(_wrap(os.makedirs))
 normpath = _wrap(os.path.normpath)
-rename = _wrap(os.rename)
-remove = _wrap(os.remove)
-rmdir = _wrap(os.rmdir)
+rename = _uncache(_wrap(os.rename))
+remove = _uncache(_wrap(os.remove))
+rmdir = _uncache(_wrap(os.rmdir))
 open = _wrap(open)
@@ -12,6 +12,7 @@ from cStringIO import StringIO
 import dnuos
 import dnuos.appdata
 import dnuos.audiodir
+import dnuos.audiotype
 import dnuos.path
 
 def test():
@@ -28,8 +29,19 @@ def test():
             dnuos.main(argv=argv, locale='C')
         finally:
             sys.stderr, sys.stdout = old
+
+        # Dirs trusted by their mtime must give the same output
+        trusted_output = StringIO()
+        sys.stderr = sys.stdout = trusted_output
+        try:
+            dnuos.main(argv=argv + ['--trust-mtime=1'], locale='C')
+            dnuos.main(argv=argv + ['--trust-mtime=1'], locale='C')
+        finally:
+            sys.stderr, sys.stdout = old
+        assert trusted_output.getvalue() == output.getvalue() * 2
+
         cache = dnuos.setup_cache(cache_file)
-        assert cache.version == dnuos.audiodir.Dir.__version__
+        assert cache.version == dnuos.dir_cache_version()
         for path, adir in cache.iteritems():
             assert dnuos.path.isdir(path)
             adir2 = dnuos.audiodir.Dir(path)
@@ -47,5 +59,38 @@ def test():
             assert adir._profiles == adir2._profiles
             assert adir.sizes == adir2.sizes
             assert adir._vendors == adir2._vendors
+        cache.save()
+
+        # The caches of an older version are taken over, and only the files
+        # whose parser has changed since are parsed again
+        version = dnuos.audiotype.StreamInfo.__version__
+        old_version = dnuos.audiotype.StreamInfo.changes[-2][0]
+        renamed = False
+        for name in os.listdir(tmpdir):
+            if name.endswith('.sqlite') and version in name:
+                os.rename(os.path.join(tmpdir, name),
+                          os.path.join(tmpdir,
+                                       name.replace(version, old_version)))
+                renamed = True
+        if renamed:
+            parsed = []
+            parse_file = dnuos.audiodir.parse_file
+            def counting_parse_file(filename):
+                parsed.append(filename)
+                return parse_file(filename)
+            migrated_output = StringIO()
+            sys.stderr = sys.stdout = migrated_output
+            dnuos.audiodir.parse_file = counting_parse_file
+            try:
+                dnuos.main(argv=argv, locale='C')
+            finally:
+                dnuos.audiodir.parse_file = parse_file
+                sys.stderr, sys.stdout = old
+            assert migrated_output.getvalue() == output.getvalue()
+            changed = dict(dnuos.audiotype.StreamInfo.changes)[version]
+            for filename in parsed:
+                assert dnuos.audiotype.extension(filename) in changed
+            assert not [name for name in os.listdir(tmpdir)
+                        if old_version in name]
     finally:
         shutil.rmtree(tmpdir, True)
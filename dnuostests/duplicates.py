@@ -0,0 +1,70 @@
+"""
+>>> test()
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from cStringIO import StringIO
+
+import dnuos
+from dnuostests.functest import write_dnuos_diff
+
+def test():
+    """Verify that directories and files seen through other paths are
+    skipped, and listed with --list-duplicates
+    """
+
+    if not hasattr(os, 'symlink'):
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # A symbolic link loop, a symbolic link to an album, and an album
+        # of hard links to the files of another
+        walk = os.path.join(tmpdir, 'walk')
+        album = os.path.join(walk, 'album')
+        linked = os.path.join(walk, 'linked')
+        shutil.copytree(os.path.join(os.environ['DATA_DIR'], 'aac', 'test1'),
+                        album)
+        names = os.listdir(album)
+        names.sort()
+        os.mkdir(linked)
+        for name in names:
+            os.link(os.path.join(album, name), os.path.join(linked, name))
+        os.symlink(walk, os.path.join(album, 'loop'))
+        os.symlink(album, os.path.join(walk, 'alias'))
+
+        expected = """
+Album/Artist
+============
+walk
+    album
+    linked
+
+Skipped the following duplicates:
+%s (same as %s)
+%s (same as %s)
+""" % (os.path.join(album, 'loop'), walk, os.path.join(walk, 'alias'), album)
+        for name in names:
+            expected += '%s (same as %s)\n' % (os.path.join(linked, name),
+                                               os.path.join(album, name))
+        write_dnuos_diff('-q --output=[n] --list-duplicates ' + walk,
+                         expected)
+
+        # The hard links are only counted once in the totals
+        old = sys.stderr, sys.stdout
+        output = StringIO()
+        sys.stderr = sys.stdout = output
+        try:
+            dnuos.main(['dnuos', '-q', '--disable-cache', '--stats', walk],
+                       locale='C')
+        finally:
+            sys.stderr, sys.stdout = old
+        size = sum([os.path.getsize(os.path.join(album, name))
+                    for name in names])
+        total = '| Total %10.2f Mb   |' % (size / (1024 * 1024.0))
+        assert total in output.getvalue().splitlines()
+    finally:
+        shutil.rmtree(tmpdir, True)
@@ -0,0 +1,23 @@
+"""
+>>> test()
+"""
+
+from dnuostests.functest import write_dnuos_diff
+
+def test():
+    """Verify directory exclusion by pattern"""
+
+    write_dnuos_diff("-q --exclude-pattern=*/test1 aac", """
+Album/Artist                                        |  Size | Type | Quality
+============================================================================
+aac                                                 |       |      | 
+    test2                                           | 1.55M | AAC  | 96 C
+""")
+
+    # A relative pattern with a slash matches the end of the path
+    write_dnuos_diff("-q --exclude-pattern=aac/test1 aac", """
+Album/Artist                                        |  Size | Type | Quality
+============================================================================
+aac                                                 |       |      | 
+    test2                                           | 1.55M | AAC  | 96 C
+""")
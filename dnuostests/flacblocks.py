@@ -0,0 +1,62 @@
+"""
+>>> test()
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+
+import dnuos.audiotype
+from dnuostests.oggtail import page
+
+
+def block(type_, data, last=False):
+    """Build a FLAC metadata block"""
+
+    return struct.pack('>I', last << 31 | type_ << 24 | len(data)) + data
+
+
+def test():
+    """Verify that the length and tags of FLAC streams are read, whether
+    they're native or in Ogg, and with other metadata blocks in between
+    """
+
+    # 10 seconds of 44.1 kHz, 16 bit stereo
+    streaminfo = struct.pack('>3HI3Q', 4096, 4096, 0, 0,
+                             44100 << 44 | 1 << 41 | 15 << 36 | 441000, 0, 0)
+    comment = (struct.pack('<I', 4) + 'test' + struct.pack('<I', 2) +
+               struct.pack('<I', 13) + 'ARTIST=Artist' +
+               struct.pack('<I', 11) + 'ALBUM=Album')
+    audio = '\x00' * 4096
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # A picture and padding too large for the head window come before
+        # the comment, which is found by skipping them
+        filename = os.path.join(tmpdir, 'test.flac')
+        head = ('fLaC' + block(0, streaminfo) + block(6, '\x00' * 100000) +
+                block(1, '\x00' * 8192))
+        assert len(head) > dnuos.audiotype.Reader.head_size
+        open(filename, 'wb').write(head + block(4, comment, True) + audio)
+        stream = dnuos.audiotype.openstream(filename)
+        assert stream.__class__ is dnuos.audiotype.FLAC
+        assert stream.time == 10
+        assert stream.artist() == {'FLAC': 'Artist'}
+        assert stream.album() == {'FLAC': 'Album'}
+
+        # In Ogg, the mapping header holds STREAMINFO, and each other block
+        # is a packet of its own
+        filename = os.path.join(tmpdir, 'test.ogg')
+        mapping = ('\x7fFLAC\x01\x00' + struct.pack('>H', 1) + 'fLaC' +
+                   block(0, streaminfo))
+        open(filename, 'wb').write(page(0, 0, [mapping], flags=2) +
+                                   page(0, 1, [block(4, comment, True)]) +
+                                   page(441000, 2, [audio], flags=4))
+        stream = dnuos.audiotype.openstream(filename)
+        assert stream.__class__ is dnuos.audiotype.OggFLAC
+        assert stream.time == 10
+        assert stream.artist() == {'FLAC': 'Artist'}
+        assert stream.album() == {'FLAC': 'Album'}
+    finally:
+        shutil.rmtree(tmpdir, True)
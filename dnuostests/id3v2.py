@@ -0,0 +1,46 @@
+"""
+>>> test()
+"""
+
+import struct
+from StringIO import StringIO
+
+import dnuos.id3
+
+
+class CountingFile(StringIO):
+    """A file in memory that counts the bytes read from it"""
+
+    def __init__(self, data):
+
+        StringIO.__init__(self, data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+
+        data = StringIO.read(self, size)
+        self.bytes_read += len(data)
+        return data
+
+
+def frame(frameid, data):
+    """Builds an ID3v2.3 frame"""
+
+    return frameid + struct.pack('>IH', len(data), 0) + data
+
+
+def test():
+    """Verify that frames that aren't wanted are skipped without being
+    read
+    """
+
+    cover = '\x00image/jpeg\x00\x03\x00' + '\xff' * (1024 * 1024)
+    frames = (frame('TIT2', '\x00Title') + frame('APIC', cover) +
+              frame('TPE1', '\x00Artist') + '\x00' * 256)
+    size = ''.join([chr(len(frames) >> shift & 0x7f)
+                    for shift in (21, 14, 7, 0)])
+    file_ = CountingFile('ID3\x03\x00\x00' + size + frames + '\x00' * 1024)
+
+    tag = dnuos.id3.ID3v2(file_, limit_frames=['TPE1'])
+    assert [(f.id, f.value) for f in tag.frames] == [('TPE1', 'Artist')]
+    assert file_.bytes_read < len(cover)
@@ -0,0 +1,52 @@
+"""
+>>> test()
+"""
+
+import os
+import shutil
+import tempfile
+
+from dnuostests.functest import write_dnuos_diff
+
+def test():
+    """Verify that ignore files keep directories out of the listing"""
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        aac = os.path.join(tmpdir, 'aac')
+        shutil.copytree(os.path.join(os.environ['DATA_DIR'], 'aac'), aac)
+
+        # A pattern leaves out matching entries below the file's directory
+        open(os.path.join(aac, '.dnuosignore'), 'w').write(
+            '# Not this one\ntest1\n')
+        write_dnuos_diff("-q " + aac, """
+Album/Artist                                        |  Size | Type | Quality
+============================================================================
+aac                                                 |       |      | 
+    test2                                           | 1.55M | AAC  | 96 C
+""")
+
+        # A leading slash anchors a pattern to the file's directory
+        shutil.copytree(os.path.join(aac, 'test2'),
+                        os.path.join(aac, 'test1', 'test2'))
+        open(os.path.join(aac, '.dnuosignore'), 'w').write('/test2\n')
+        write_dnuos_diff("-q " + aac, """
+Album/Artist                                        |  Size | Type | Quality
+============================================================================
+aac                                                 |       |      | 
+    test1                                           | 1.55M | AAC  | 96 C
+        test2                                       | 1.55M | AAC  | 96 C
+""")
+        shutil.rmtree(os.path.join(aac, 'test1', 'test2'))
+
+        # An empty file leaves out its whole directory
+        os.remove(os.path.join(aac, '.dnuosignore'))
+        open(os.path.join(aac, 'test2', '.dnuosignore'), 'w').close()
+        write_dnuos_diff("-q " + aac, """
+Album/Artist                                        |  Size | Type | Quality
+============================================================================
+aac                                                 |       |      | 
+    test1                                           | 1.55M | AAC  | 96 C
+""")
+    finally:
+        shutil.rmtree(tmpdir, True)
@@ -0,0 +1,15 @@
+"""
+>>> test()
+"""
+
+from dnuostests.functest import write_dnuos_diff
+
+def test():
+    """Verify that directories below the maximum depth are left out"""
+
+    write_dnuos_diff("-q --max-depth=1 walk", """
+Album/Artist                                        |  Size | Type | Quality
+============================================================================
+walk                                                |       |      | 
+    b                                               |  146k | MP3  | -apfe
+    """)
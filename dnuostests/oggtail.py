@@ -0,0 +1,47 @@
+"""
+>>> test()
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+
+import dnuos.audiotype
+
+
+def page(granule, sequence, packets, flags=0):
+    """Build an Ogg page of one stream holding the given packets"""
+
+    lacing = ''
+    for packet in packets:
+        lacing += chr(255) * (len(packet) // 255) + chr(len(packet) % 255)
+    return ('OggS' + struct.pack('<BBqIIIB', 0, flags, granule, 1, sequence,
+                                 0, len(lacing)) +
+            lacing + ''.join(packets))
+
+
+def test():
+    """Verify that a short last page still gives the length of a stream"""
+
+    ident = '\x01vorbis' + struct.pack('<IBI3iB', 0, 2, 44100, 0, 128000, 0,
+                                       0xb8) + '\x01'
+    comment = '\x03vorbis' + struct.pack('<I', 4) + 'test' + \
+              struct.pack('<I', 0) + '\x01'
+    stream = (page(0, 0, [ident], flags=2) +
+              page(0, 1, [comment]) +
+              page(441000, 2, ['\x00' * 4096]))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'test.ogg')
+        open(filename, 'wb').write(stream)
+        assert dnuos.audiotype.openstream(filename).time == 10.0
+
+        # An empty end of stream page is only 28 bytes long
+        eos = page(882000, 3, [''], flags=4)
+        assert len(eos) == 28
+        open(filename, 'wb').write(stream + eos)
+        assert dnuos.audiotype.openstream(filename).time == 20.0
+    finally:
+        shutil.rmtree(tmpdir, True)
@@ -0,0 +1,52 @@
+"""
+>>> test()
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from cStringIO import StringIO
+
+import dnuos
+import dnuos.path
+
+def test():
+    """Verify that directories on other file systems are skipped, and
+    listed with --stats
+    """
+
+    tmpdir = tempfile.mkdtemp()
+    aac = os.path.join(tmpdir, 'aac')
+    mount = os.path.join(aac, 'test2')
+    stat = dnuos.path.stat
+
+    def other_fs_stat(path):
+        """Makes mount and everything below it look like another device"""
+
+        result = stat(path)
+        if path == mount or path.startswith(mount + os.sep):
+            result = list(result)
+            result[2] += 1
+            result = os.stat_result(result)
+        return result
+
+    old = sys.stderr, sys.stdout
+    try:
+        shutil.copytree(os.path.join(os.environ['DATA_DIR'], 'aac'), aac)
+        output = StringIO()
+        sys.stderr = sys.stdout = output
+        dnuos.path.stat = other_fs_stat
+        try:
+            dnuos.main(['dnuos', '-q', '--disable-cache', '--output=[n]',
+                        '--one-file-system', '--stats', aac], locale='C')
+        finally:
+            dnuos.path.stat = stat
+            sys.stderr, sys.stdout = old
+        lines = output.getvalue().splitlines()
+        assert lines[:4] == ['Album/Artist', '============', 'aac',
+                             '    test1']
+        assert lines[-3:] == ['', 'Skipped the following directories on '
+                              'other file systems:', mount]
+    finally:
+        shutil.rmtree(tmpdir, True)